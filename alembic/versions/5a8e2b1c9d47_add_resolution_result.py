@@ -0,0 +1,32 @@
+"""
+Add resolution_result table
+
+Create Date: 2026-10-17 10:12:41.508213
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5a8e2b1c9d47'
+down_revision = 'c3e9459e893f'
+
+from alembic import op
+
+
+def upgrade():
+    op.execute("""
+CREATE TABLE resolution_result (
+    collection_id integer NOT NULL REFERENCES collection(id) ON DELETE CASCADE,
+    repo_id integer NOT NULL,
+    requires_hash character varying NOT NULL,
+    build_group_hash character varying NOT NULL,
+    dependency_keys bytea NOT NULL,
+    distances integer[] NOT NULL,
+    PRIMARY KEY (collection_id, repo_id, requires_hash, build_group_hash)
+);
+    """)
+
+
+def downgrade():
+    op.execute("""
+        DROP TABLE resolution_result;
+    """)
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+# Copyright (C) 2016 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Benchmark of encoding/decoding speed and size of CompressedKeyArray formats
+# on dependency keys of real builds from the development database (see
+# aux/resync_db).
+#
+# Usage: aux/compressed-key-array-bench.py [number of builds]
+
+import struct
+import sys
+import time
+import zlib
+
+from koschei.config import load_config
+
+load_config(['config.cfg.template', 'aux/test-config.cfg'])
+
+from koschei.db import get_engine, CompressedKeyArray
+
+
+def encode_v1(value):
+    value = sorted(value)
+    offset = 0
+    for i in range(len(value)):
+        value[i] -= offset
+        offset += value[i]
+    array = bytearray()
+    for item in value:
+        array += struct.pack(">I", item)
+    return zlib.compress(array)
+
+
+def decode_v1(value):
+    res = []
+    uncompressed = zlib.decompress(value)
+    for i in range(0, len(uncompressed), 4):
+        res.append(struct.unpack(">I", uncompressed[i:i + 4])[0])
+    offset = 0
+    for i in range(len(res)):
+        res[i] += offset
+        offset = res[i]
+    return res
+
+
+def bench(name, encode, decode, key_sets):
+    start = time.time()
+    encoded = [encode(keys) for keys in key_sets]
+    encode_time = time.time() - start
+    start = time.time()
+    decoded = [decode(value) for value in encoded]
+    decode_time = time.time() - start
+    assert decoded == key_sets
+    print("{:>3}: encode {:7.3f} s, decode {:7.3f} s, {:8.1f} KiB".format(
+        name, encode_time, decode_time,
+        sum(len(value) for value in encoded) / 1024,
+    ))
+
+
+def main():
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    column_type = CompressedKeyArray()
+    rows = get_engine().execute(
+        "SELECT dependency_keys FROM build WHERE dependency_keys IS NOT NULL "
+        "ORDER BY id DESC LIMIT %s", (limit,)
+    ).fetchall()
+    key_sets = [column_type.process_result_value(row[0], None) for row in rows]
+    print("{} builds, {} keys".format(
+        len(key_sets), sum(len(keys) for keys in key_sets)
+    ))
+    bench('v1', encode_v1, decode_v1, key_sets)
+    bench('v2', lambda value: column_type.process_bind_param(value, None),
+          lambda value: column_type.process_result_value(value, None),
+          key_sets)
+
+
+if __name__ == '__main__':
+    main()
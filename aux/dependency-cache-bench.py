@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+# Copyright (C) 2016 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Microbenchmark comparing memory usage and access speed of DependencyCache
+# with the previous OrderedDict based implementation. Doesn't need a database.
+#
+# Usage: aux/dependency-cache-bench.py [capacity] [accesses]
+
+import random
+import sys
+import time
+import tracemalloc
+
+from collections import OrderedDict
+
+from koschei.backend.services.resolver import DependencyCache, DepTuple
+
+
+class OrderedDictCache(object):
+    """The previous implementation (without database access)"""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.nevras = {}
+        self.ids = OrderedDict()
+
+    def _add(self, dep):
+        self.ids[dep.id] = dep
+        self.nevras[(dep.name, dep.epoch, dep.version, dep.release,
+                     dep.arch)] = dep
+        if len(self.ids) > self.capacity:
+            _, victim = self.ids.popitem(last=False)
+            del self.nevras[(victim.name, victim.epoch, victim.version,
+                             victim.release, victim.arch)]
+
+    def get_by_ids(self, ids):
+        res = []
+        for dep_id in ids:
+            dep = self.ids.pop(dep_id)
+            self.ids[dep_id] = dep
+            res.append(dep)
+        return res
+
+
+def make_deps(count):
+    # names repeat across versions, as in real repos
+    return [
+        DepTuple(
+            i, 'package-name-{}'.format(i % (count // 4 + 1)), 0,
+            '{}.{}.{}'.format(i % 7, i % 13, i % 3), '{}.fc26'.format(i % 5),
+            random.choice(['x86_64', 'noarch', 'i686']),
+        )
+        for i in range(count)
+    ]
+
+
+def bench(name, cache, capacity, accesses):
+    tracemalloc.start()
+    # fresh objects from the database don't share strings
+    for dep in make_deps(capacity):
+        cache._add(DepTuple(dep.id, *(
+            ''.join(list(field)) if isinstance(field, str) else field
+            for field in dep[1:]
+        )))
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    keys = list(range(capacity))
+    chunks = [random.sample(keys, 500) for _ in range(accesses // 500)]
+    start = time.time()
+    for chunk in chunks:
+        cache.get_by_ids(chunk)
+    duration = time.time() - start
+
+    evictions = make_deps(capacity * 2)[capacity:]
+    start = time.time()
+    for dep in evictions:
+        cache._add(dep)
+    evict_duration = time.time() - start
+
+    print("{:>12}: {:8.1f} MiB, {:10.0f} accesses/s, {:10.0f} inserts/s".format(
+        name, memory / 1024 / 1024, accesses / duration,
+        len(evictions) / evict_duration,
+    ))
+
+
+def main():
+    capacity = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    accesses = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+    random.seed(42)
+    bench('OrderedDict', OrderedDictCache(capacity), capacity, accesses)
+    random.seed(42)
+    bench('clock', DependencyCache(None, capacity), capacity, accesses)
+
+
+if __name__ == '__main__':
+    main()
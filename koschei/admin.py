@@ -25,11 +25,13 @@ import pwd
 import logging
 import argparse
 
+from sqlalchemy import func, update, bindparam
+
 from koschei import data, backend, plugin
 from koschei.backend import koji_util
-from koschei.db import get_engine, create_all, get_or_create
+from koschei.db import get_engine, create_all, get_or_create, CompressedKeyArray
 from koschei.models import (
-    Package, PackageGroup, AdminNotice, Collection, User, LogEntry,
+    Build, Package, PackageGroup, AdminNotice, Collection, User, LogEntry,
     CollectionGroup, CollectionGroupRelation,
 )
 from koschei.config import get_config
@@ -152,6 +154,46 @@ class Cleanup(Command):
         plugin.dispatch_event('cleanup', session, older_than)
 
 
+class ReencodeDependencyKeys(Command):
+    """
+    Rewrites dependency keys of builds stored in older format to the current
+    one. Older formats remain readable, so this can be run anytime.
+    """
+
+    def setup_parser(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Number of builds updated in one transaction")
+
+    def execute(self, session, batch_size):
+        db = session.db
+        version = CompressedKeyArray.VERSION
+        last_id = 0
+        total = 0
+        while True:
+            builds = (
+                db.query(Build.id, Build.dependency_keys)
+                .filter(Build.id > last_id)
+                .filter(Build.dependency_keys != None)
+                .filter(func.get_byte(Build.dependency_keys, 0) != version)
+                .order_by(Build.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not builds:
+                break
+            db.execute(
+                update(Build)
+                .where(Build.id == bindparam('build_id'))
+                .values(dependency_keys=bindparam('keys')),
+                [dict(build_id=build.id, keys=build.dependency_keys)
+                 for build in builds],
+            )
+            db.commit()
+            last_id = builds[-1].id
+            total += len(builds)
+            print("Reencoded dependency keys of {} builds".format(total))
+
+
 class SetNotice(Command):
     """ Set admin notice displayed in web interface """
 
@@ -29,7 +29,7 @@ from koschei.session import KoscheiSession
 from koschei.config import get_config
 from koschei.backend import koji_util
 from koschei.backend.koji_util import itercall
-from koschei.db import Session
+from koschei.db import Session, get_engine
 from koschei.models import (
     Build, UnappliedChange, KojiTask, Package, BasePackage, Collection, RepoMapping,
     LogEntry,
@@ -63,6 +63,29 @@ class KoscheiBackendSession(KoscheiSession):
     def close(self):
         if self._db:
             self._db.close_connection()
+        self.clear_resident_sacks()
+
+    def clear_resident_sacks(self):
+        """
+        Drops sacks kept loaded by the repo cache, if it was used.
+        Returns whether there were any.
+        """
+        if self._repo_cache is None or not self._repo_cache.resident:
+            return False
+        self._repo_cache.clear_resident()
+        return True
+
+    def reset_after_fork(self):
+        """
+        Drops resources inherited from the parent process that cannot be
+        shared with it - database connections, Koji sessions and repo cache
+        (file locks of its loaded sacks are not inherited). They are created
+        again on demand.
+        """
+        get_engine().dispose(close=False)
+        self._db = None
+        self._koji_sessions = {}
+        self._repo_cache = None
 
     @property
     def build_from_repo_id(self):
@@ -24,19 +24,280 @@ from hawkey/libdnf.
 
 import hawkey
 
+from array import array
+
+from koschei import util
 from koschei.config import get_config
 
 
+class SelectorCache(object):
+    """
+    Memoizes selectors of dependency strings (BuildRequires and build group
+    entries) for a single sack. The same strings repeat for most packages in a
+    repo, so it's not necessary to construct a hawkey.Selector and run its
+    query every time.
+    """
+    def __init__(self):
+        self.selectors = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.selectors = {}
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        return ', '.join([
+            f'hits={self.hits}',
+            f'misses={self.misses}',
+            f'hit_rate={self.hits / total if total else 0:.1%}',
+            f'total_items={len(self.selectors)}',
+        ])
+
+
+class Sack(hawkey.Sack):
+    """
+    hawkey.Sack carrying additional data derived from its contents, which are
+    dropped together with the sack. The data need to be cleared by calling
+    `clear_caches` whenever the contents change (i.e. when loading another
+    repo into the sack).
+    """
+    def __init__(self, *args, **kwargs):
+        super(Sack, self).__init__(*args, **kwargs)
+        self.selector_cache = SelectorCache()
+        self.dependency_graph = None
+        # FileProvides of a sack loaded without filelists
+        self.file_provides = None
+
+    def clear_caches(self):
+        self.selector_cache.clear()
+        self.dependency_graph = None
+
+
+class FileProvides(object):
+    """
+    Answers which packages provide given file paths for a sack loaded
+    without filelists (only files from primary metadata are present in such
+    sack). The filelists are loaded, into a separate sack in a forked
+    process, only when a path that hasn't been asked for before is queried,
+    so that the memory they take is released right afterwards. Answers are
+    kept for the lifetime of the sack.
+
+    :load_full_sack: function returning a hawkey.Sack with the same repo
+                     loaded including filelists
+    """
+    def __init__(self, load_full_sack):
+        self.load_full_sack = load_full_sack
+        self.names = {}
+        self.loads = 0
+
+    def _query(self, paths):
+        sack = self.load_full_sack()
+        return {
+            path: sorted({pkg.name for pkg in hawkey.Query(sack).filter(file=path)})
+            for path in paths
+        }
+
+    def prefetch(self, paths):
+        """
+        Looks up all given paths that weren't looked up yet at once.
+        """
+        missing = sorted(set(paths) - self.names.keys())
+        if missing:
+            self.loads += 1
+            self.names.update(util.run_in_process(self._query, missing))
+
+    def get(self, path):
+        """
+        Returns sorted list of names of packages containing given file.
+        """
+        self.prefetch([path])
+        return self.names[path]
+
+
+def _find_file_dep(sack, dep):
+    """
+    Returns a pair of (hawkey.Selector, list of matching packages) for a file
+    dependency, that doesn't match anything by provides.
+    """
+    sltr = hawkey.Selector(sack)
+    sltr.set(file=dep)
+    found = sltr.matches()
+    file_provides = getattr(sack, 'file_provides', None)
+    if not found and file_provides:
+        # The file may be only in filelists that weren't loaded
+        names = file_provides.get(dep)
+        if names:
+            sltr = hawkey.Selector(sack)
+            sltr.set(pkg=hawkey.Query(sack).filter(name=names))
+            found = sltr.matches()
+    return sltr, found
+
+
+def prefetch_file_provides(sack, deps, before_fork=None):
+    """
+    Looks up all file dependencies from given dependency strings, that cannot
+    be resolved without filelists, in a single filelists load. Should be
+    called before resolving dependencies in a batch or in forked processes,
+    which would otherwise load the filelists separately.
+
+    :param before_fork: function called before forking the process loading
+                        the filelists, if they need to be loaded
+    """
+    file_provides = getattr(sack, 'file_provides', None)
+    if file_provides:
+        paths = [
+            dep for dep in set(deps)
+            if dep.startswith('/') and dep not in file_provides.names
+            and not hawkey.Query(sack).filter(provides=dep)
+            and not hawkey.Query(sack).filter(file=dep)
+        ]
+        if paths and before_fork:
+            before_fork()
+        file_provides.prefetch(paths)
+
+
+COMPARISON_OPERATORS = {'<', '<=', '=', '==', '>=', '>'}
+RICH_DEP_OPERATORS = {'and', 'or', 'if', 'else', 'with', 'without', 'unless'}
+
+
+def dep_names(dep):
+    """
+    Returns names referenced by given dependency string (i.e. BuildRequires or
+    string form of hawkey.Reldep), which may be a rich dependency. Versions are
+    omitted. Names with arguments, such as perl(strict) or
+    libc.so.6()(64bit), are kept whole.
+    """
+    names = set()
+    tokens = iter(str(dep).split())
+    for token in tokens:
+        # strip parentheses of rich dependencies
+        token = token.lstrip('(')
+        while token.endswith(')') and token.count(')') > token.count('('):
+            token = token[:-1]
+        if token in COMPARISON_OPERATORS:
+            next(tokens, None)  # version
+        elif token and token not in RICH_DEP_OPERATORS:
+            names.add(token)
+    return names
+
+
+def _find_providers(sack, index, providers, pkg):
+    """
+    Returns indices of packages providing any of the requires of given package.
+    Providers of each require string are memoized in providers dict.
+    """
+    neighbors = set()
+    for req in pkg.requires:
+        key = str(req)
+        found = providers.get(key)
+        if found is None:
+            found = providers[key] = [
+                index[provider] for provider in
+                hawkey.Query(sack).filter(provides=req)
+                if provider in index
+            ]
+        neighbors.update(found)
+    return sorted(neighbors)
+
+
+class DependencyGraph(object):
+    """
+    Graph of all packages in a sack, where edges go from a package to all
+    packages providing any of its requires. Stored in compressed sparse row
+    form - neighbors of package with index i are
+    targets[offsets[i]:offsets[i + 1]].
+    """
+    def __init__(self, sack):
+        pkgs = list(hawkey.Query(sack))
+        self.index = {pkg: i for i, pkg in enumerate(pkgs)}
+        self.names = [pkg.name for pkg in pkgs]
+        self.offsets = array('I', [0])
+        self.targets = array('I')
+        providers = {}
+        for pkg in pkgs:
+            self.targets.extend(_find_providers(sack, self.index, providers, pkg))
+            self.offsets.append(len(self.targets))
+
+    def neighbors(self, i):
+        return self.targets[self.offsets[i]:self.offsets[i + 1]]
+
+
+class LazyDependencyGraph(object):
+    """
+    Same graph as DependencyGraph, but neighbors of a package are looked up
+    only when the package is visited. Meant for sacks that are used only for
+    a few distance computations (i.e. in forked processes that modify their
+    copy of the sack), where building the whole graph would cost more than
+    the computations themselves.
+    """
+    def __init__(self, sack):
+        self.sack = sack
+        self.pkgs = list(hawkey.Query(sack))
+        self.index = {pkg: i for i, pkg in enumerate(self.pkgs)}
+        self.names = [pkg.name for pkg in self.pkgs]
+        self.providers = {}
+        self.edges = {}
+
+    def neighbors(self, i):
+        found = self.edges.get(i)
+        if found is None:
+            found = self.edges[i] = _find_providers(
+                self.sack, self.index, self.providers, self.pkgs[i],
+            )
+        return found
+
+
+def get_dependency_graph(sack):
+    """
+    Returns DependencyGraph of given sack. The graph is built on first use and
+    kept for the lifetime of the sack if the sack supports it. A
+    LazyDependencyGraph may be assigned to the sack's dependency_graph instead
+    to avoid building the whole graph.
+    """
+    graph = getattr(sack, 'dependency_graph', None)
+    if graph is None:
+        graph = DependencyGraph(sack)
+        if hasattr(sack, 'dependency_graph'):
+            sack.dependency_graph = graph
+    return graph
+
+
 def _get_builddep_selector(sack, dep):
+    """
+    Returns a pair of (hawkey.Selector, list of matching packages) for given
+    dependency string. Uses the sack's selector cache if it has one.
+    """
+    cache = getattr(sack, 'selector_cache', None)
+    if cache is not None:
+        entry = cache.selectors.get(dep)
+        if entry is not None:
+            cache.hits += 1
+            return entry
+        cache.misses += 1
     # Try to find something by provides
     sltr = hawkey.Selector(sack)
     sltr.set(provides=dep)
     found = sltr.matches()
     if not found and dep.startswith("/"):
         # Nothing matches by provides and since it's file, try by files
-        sltr = hawkey.Selector(sack)
-        sltr.set(file=dep)
-    return sltr
+        sltr, found = _find_file_dep(sack, dep)
+    entry = (sltr, found)
+    if cache is not None:
+        cache.selectors[dep] = entry
+    return entry
+
+
+def get_provider_names(sack, deps):
+    """
+    Returns names of packages that match given dependency strings the same
+    way as when they're passed to `run_goal` as BuildRequires.
+
+    :param sack: hawkey.Sack to query
+    :param deps: List of dependencies (strings from BuildRequires)
+    :return: set of package names
+    """
+    return {pkg.name for dep in deps for pkg in _get_builddep_selector(sack, dep)[1]}
 
 
 def run_goal(sack, br, group):
@@ -60,14 +321,13 @@ def run_goal(sack, br, group):
     goal = hawkey.Goal(sack)
     problems = []
     for name in group:
-        sltr = _get_builddep_selector(sack, name)
-        if sltr.matches():
+        sltr, found = _get_builddep_selector(sack, name)
+        if found:
             # missing packages are silently skipped as in dnf
             goal.install(select=sltr)
     for r in br:
-        sltr = _get_builddep_selector(sack, r)
-        # pylint: disable=E1103
-        if sltr.matches():
+        sltr, found = _get_builddep_selector(sack, r)
+        if found:
             goal.install(select=sltr)
         elif not r.startswith("("):
             problems.append("No package found for: {}".format(r))
@@ -98,13 +358,13 @@ class DependencyWithDistance(object):
         self.distance = None
 
 
-def compute_dependency_distances(sack, br, deps):
+def compute_dependency_distances(sack, br, deps, depth_limit=None):
     """
     Computes dependency distance of given dependencies.
     Dependency distance is the length of the shortest path from any of the first-level
     dependencies (BuildRequires) to the dependency node in the dependency graph.
-    The algorithm is only a best-effort approximation that uses hawkey queries.
-    It is a variant of depth-limited BFS (depth limit is hardcoded to 5).
+    The algorithm is only a best-effort approximation that does a depth-limited BFS
+    in the sack's DependencyGraph.
     Dependency objects are mutated in place. Objects that weren't reached keep their
     original distance (None).
 
@@ -113,22 +373,28 @@ def compute_dependency_distances(sack, br, deps):
                be included.
     :param deps: List of DependencyWithDistance objects for all dependencies that were
                  marked to be installed.
+    :param depth_limit: Only dependencies with distance lower than this are reached.
+                        Taken from configuration by default.
     """
+    if depth_limit is None:
+        depth_limit = get_config('dependency.distance_depth_limit')
+    graph = get_dependency_graph(sack)
     dep_map = {dep.name: dep for dep in deps}
-    visited = set()
+    nodes_on_level = {
+        graph.index[pkg] for r in br for pkg in _get_builddep_selector(sack, r)[1]
+        if pkg in graph.index
+    }
+    visited = set(nodes_on_level)
     level = 1
-    # pylint:disable=E1103
-    pkgs_on_level = {x for r in br for x in
-                     _get_builddep_selector(sack, r).matches()}
-    while pkgs_on_level:
-        for pkg in pkgs_on_level:
-            dep = dep_map.get(pkg.name)
+    while nodes_on_level and level < depth_limit:
+        for node in nodes_on_level:
+            dep = dep_map.get(graph.names[node])
             if dep and dep.distance is None:
                 dep.distance = level
         level += 1
-        if level >= 5:
-            break
-        reldeps = {req for pkg in pkgs_on_level if pkg not in visited
-                   for req in pkg.requires}
-        visited.update(pkgs_on_level)
-        pkgs_on_level = set(hawkey.Query(sack).filter(provides=reldeps))
+        next_level = set()
+        for node in nodes_on_level:
+            next_level.update(graph.neighbors(node))
+        next_level -= visited
+        visited.update(next_level)
+        nodes_on_level = next_level
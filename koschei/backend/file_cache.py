@@ -24,8 +24,11 @@ import logging
 import os
 import shutil
 import json
+import time
 import contextlib
 
+from collections import Counter
+
 from koschei.util import FileLock
 
 
@@ -45,7 +48,8 @@ class FileCache(object):
     Specializations need to override read_item and create_item methods.
 
     Algorithm notes and invariants:
-    - entries are stored in an index file
+    - entries are stored in an index file, each entry records item's state,
+      time of last access and size on disk
     - an item can be in two states
         - "preparing" - being prepared. It only serves as a placeholder that
           reserves capacity
@@ -58,14 +62,32 @@ class FileCache(object):
     - index file is locked to ensure transactionality of operations,
       but it's not a global lock for the cache
     - never block on item lock while holding index lock
+    - when the cache is full (by number of items or by their total size),
+      least recently used items that are not locked by this process are
+      evicted
     """
 
-    INDEX_VERSION = 1
+    INDEX_VERSION = 2
 
-    def __init__(self, cachedir, capacity, log=None):
+    def __init__(self, cachedir, capacity, log=None, capacity_bytes=None,
+                 external_links=0):
+        """
+        :external_links: number of hardlinks to files of items that are kept
+                         outside of the cache (i.e. in a store of deduplicated
+                         files). Their space is counted against the items.
+        """
         self.log = log or logging.getLogger('koschei.file_cache.FileCache')
         self._cachedir = cachedir
         self._capacity = capacity
+        self._capacity_bytes = capacity_bytes
+        self._external_links = external_links
+        # keys of items locked by this process. POSIX locks belong to the
+        # process, so locking them again would release them
+        self._held = Counter()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._index_upgraded = False
 
     def read_item(self, cache_key, cachedir):
         """
@@ -88,6 +110,42 @@ class FileCache(object):
         """
         return os.path.join(self._cachedir, filename)
 
+    @staticmethod
+    def _new_entry(state, size=0, atime=None):
+        return dict(state=state, atime=atime or time.time(), size=size)
+
+    def _disk_usage(self, key):
+        """
+        Returns disk space used by item with given key in bytes. Space of
+        files hardlinked from multiple items is divided between them, links
+        from outside of the cache don't get a share.
+        """
+        total = 0
+        for dirpath, _, filenames in os.walk(self._p(key)):
+            for filename in filenames:
+                try:
+                    stat = os.lstat(os.path.join(dirpath, filename))
+                except OSError:
+                    continue
+                links = max(1, stat.st_nlink - self._external_links)
+                total += stat.st_blocks * 512 // links
+        return total
+
+    def _migrate_entries_v1(self, entries):
+        """
+        Converts entries of index version 1, which recorded only item
+        states. Last access time is approximated by modification time.
+        """
+        return {
+            key: self._new_entry(
+                'ready',
+                size=self._disk_usage(key),
+                atime=os.path.getmtime(self._p(key)),
+            )
+            for key, state in entries.items()
+            if state == 'ready' and os.path.isdir(self._p(key))
+        }
+
     def _read_index(self, silent=False):
         """
         Reads entries from index file. If the file is invalid or of older
@@ -104,6 +162,8 @@ class FileCache(object):
                         raise CacheVersionMismatch(
                             "Cache index version is newer than current"
                         )
+                    elif index_content['version'] == 1:
+                        entries = self._migrate_entries_v1(index_content['entries'])
                     elif index_content['version'] < self.INDEX_VERSION:
                         if not silent:
                             self.log.info("Cache index version is old. "
@@ -120,6 +180,26 @@ class FileCache(object):
                         )
         return entries
 
+    def _upgrade_index(self):
+        """
+        Rewrites index of older version that can be migrated, so that the
+        migration is done only once and not on every read.
+        """
+        self._index_upgraded = True
+        index_path = self._p('index.json')
+        if not os.path.exists(index_path):
+            return
+        with FileLock(self._cachedir, 'index', exclusive=True):
+            try:
+                with open(index_path) as index:
+                    version = json.load(index)['version']
+            except Exception:
+                return  # will be discarded by _read_index
+            if version == 1:
+                self.log.info("Migrating cache index to version %d",
+                              self.INDEX_VERSION)
+                self._write_index(self._read_index())
+
     def _write_index(self, entries):
         """
         Writes entries to the index file.
@@ -139,9 +219,10 @@ class FileCache(object):
         Expects index to be exclusively locked. Writes to index file.
         """
         dirents = [d for d in os.listdir(self._cachedir)
-                   if os.path.isdir(self._p(d)) and not d == exclude]
+                   if os.path.isdir(self._p(d)) and not d == exclude and
+                   d not in self._held]
         for dirent in dirents:
-            if entries.get(dirent) != 'ready':
+            if (entries.get(dirent) or {}).get('state') != 'ready':
                 with FileLock(self._cachedir, dirent, exclusive=True,
                               immediate=False) as lock:
                     if lock.try_lock():
@@ -151,17 +232,124 @@ class FileCache(object):
                         shutil.rmtree(self._p(dirent), ignore_errors=True)
         self._write_index(entries)
 
+    def _is_full(self, entries):
+        if len(entries) >= self._capacity:
+            return True
+        if self._capacity_bytes:
+            size = sum(entry['size'] for entry in entries.values())
+            return size >= self._capacity_bytes
+        return False
+
+    def _evict(self, entries, key):
+        """
+        Removes least recently used ready entries until the cache has space
+        for a new item with given key. Items locked by this process are
+        skipped.
+        Expects index to be exclusively locked. Writes to index file.
+        """
+        victims = sorted(
+            (k for k, v in entries.items()
+             if v['state'] == 'ready' and k not in self._held),
+            key=lambda k: entries[k]['atime'],
+        )
+        evicted = []
+        for victim in victims:
+            if not self._is_full(entries):
+                break
+            del entries[victim]
+            evicted.append(victim)
+        if evicted:
+            self.evictions += len(evicted)
+            self.log.info("Evicting %s", ', '.join(evicted))
+            # will delete unreferenced items from disk
+            self._cleanup_items(entries, exclude=key)
+
+    def _touch(self, index_lock, key):
+        """
+        Records access to an item. Expects the index not to be locked.
+        """
+        index_lock.lock(exclusive=True)
+        entries = self._read_index(silent=True)
+        entry = entries.get(key)
+        if entry:
+            entry['atime'] = time.time()
+            self._write_index(entries)
+        index_lock.unlock()
+
+    def touch(self, cache_key):
+        """
+        Records access to an item, which is used without calling get_item
+        again (i.e. kept loaded in memory), so that it's not evicted as least
+        recently used.
+        """
+        with FileLock(self._cachedir, 'index', immediate=False) as index_lock:
+            self._touch(index_lock, str(cache_key))
+
+    def _log_stats(self, entries):
+        size = sum(entry['size'] for entry in entries.values())
+        self.log.info(
+            "Cache statistics: %d hits, %d misses, %d evictions, "
+            "%d items, %d MiB used",
+            self.hits, self.misses, self.evictions, len(entries),
+            size // (1024 * 1024),
+        )
+
+    def prefetch(self, cache_key):
+        """
+        Makes sure that item with given key is present on disk, creating it if
+        necessary. Unlike get_item, doesn't read an already present item.
+
+        :returns: whether the item is available
+        """
+        with self.get_item(cache_key, read=False) as item:
+            return bool(item)
+
     @contextlib.contextmanager
-    def get_item(self, cache_key):
+    def get_item(self, cache_key, read=True):
+        """
+        Returns item with given key while holding read lock on it. Creates
+        the item if it's not present.
+
+        :param: read whether to read an item that is already present.
+                     Otherwise True is returned in place of the item.
+        """
+        key = str(cache_key)
+        if not self._index_upgraded:
+            self._upgrade_index()
+        with self._get_item(cache_key, read) as item:
+            self._held[key] += 1
+            try:
+                yield item
+            finally:
+                self._held[key] -= 1
+                if not self._held[key]:
+                    del self._held[key]
+
+    @contextlib.contextmanager
+    def _get_item(self, cache_key, read):
         key = str(cache_key)
 
         while True:
+            # fast path - the item is usually present and other processes may
+            # be holding read locks on it for a long time
+            with FileLock(self._cachedir, key, exclusive=False) as item_lock:
+                with FileLock(self._cachedir, 'index', exclusive=False) as index_lock:
+                    entry = self._read_index(silent=True).get(key)
+                if entry and entry['state'] == 'ready':
+                    self._touch(index_lock, key)
+                    self.hits += 1
+                    if not read:
+                        yield True
+                        return
+                    yield self.read_item(cache_key, self._cachedir)
+                    return
             with FileLock(self._cachedir, key, exclusive=True) as item_lock:
                 with FileLock(self._cachedir, 'index', exclusive=True) as index_lock:
                     entries = self._read_index()
                     entry = entries.get(key)
-                    if entry and entry == 'ready':
-                        # other process added it in the meantime
+                    if entry and entry['state'] == 'ready':
+                        # other process added it in the meantime (or we lost
+                        # it between the fast path and exclusive locking)
                         index_lock.unlock()
                         # relax the item lock to shared
                         item_lock.lock(exclusive=False)
@@ -169,31 +357,28 @@ class FileCache(object):
                         # relocking to be atomic, so I must assume it isn't
                         index_lock.lock(exclusive=False)
                         entry = self._read_index(silent=True).get(key)
-                        if entry and entry == 'ready':
+                        if entry and entry['state'] == 'ready':
                             index_lock.unlock()
+                            self._touch(index_lock, key)
+                            self.hits += 1
+                            if not read:
+                                yield True
+                                return
                             yield self.read_item(cache_key, self._cachedir)
                             return
                         # we lost it during relocking
                         continue
                     entries.pop(key, None)
                     # ok, it's definitely not there, we have to add it
-                    if len(entries) >= self._capacity:
+                    self.misses += 1
+                    if self._is_full(entries):
                         # discard invalid repos
                         self._cleanup_items(entries, exclude=key)
-                    if len(entries) >= self._capacity:
-                        # discard old repos
-                        ready_repos = (k for k, v in entries.items() if v == 'ready')
-                        victims = sorted(
-                            ready_repos,
-                            key=lambda r: os.path.getmtime(self._p(r))
-                        )[:len(entries) - self._capacity + 1]
-                        for victim in victims:
-                            del entries[victim]
-                        if victims:
-                            # will delete unreferenced items from disk
-                            self._cleanup_items(entries, exclude=key)
-
-                    if len(entries) >= self._capacity:
+                    if self._is_full(entries):
+                        # discard least recently used repos
+                        self._evict(entries, key)
+
+                    if self._is_full(entries):
                         raise CacheExhaustedException(
                             "Cannot free space for new cache item. "
                             "Increase the cache size or decrease the number "
@@ -201,7 +386,7 @@ class FileCache(object):
                         )
 
                     # we have capacity - add new item
-                    entries[key] = 'preparing'
+                    entries[key] = self._new_entry('preparing')
                     self._write_index(entries)
                     index_lock.unlock()
 
@@ -212,8 +397,11 @@ class FileCache(object):
                     index_lock.lock()
                     entries = self._read_index()
                     if item:
-                        entries[key] = 'ready'
+                        entries[key] = self._new_entry(
+                            'ready', size=self._disk_usage(key),
+                        )
                         self._write_index(entries)
+                        self._log_stats(entries)
                     else:
                         entries.pop(key)
                         self._write_index(entries)
@@ -225,7 +413,7 @@ class FileCache(object):
                     item_lock.lock(exclusive=False)
                     index_lock.lock(exclusive=False)
                     entry = self._read_index(silent=True).get(key)
-                    if entry and entry == 'ready':
+                    if entry and entry['state'] == 'ready':
                         index_lock.unlock()
                         yield item
                         return
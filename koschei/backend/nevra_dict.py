@@ -0,0 +1,252 @@
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Provides a persistent mapping between dependency NEVRAs and their ids in the
+dependency table, shared by all backend processes on the same host.
+"""
+
+import logging
+import mmap
+import os
+import struct
+
+from array import array
+
+from koschei.util import FileLock
+
+
+class NevraDict(object):
+    """
+    Append-only file of (id, NEVRA) records of the dependency table. Rows of
+    the dependency table are never modified or deleted, so a record never gets
+    outdated once its row is committed. Only committed rows may be added.
+
+    Record format: big-endian u32 id, u16 payload length and the payload -
+    NEVRA fields (epoch as decimal string, empty when null) separated by zero
+    bytes.
+
+    The file is memory-mapped and each process keeps its own index of records
+    that it has seen, which is updated by reading only records appended since
+    the last read. The index consists of two open-addressing hash tables of
+    32-bit record offsets, keyed by the payload and by id, so its size is
+    proportional to the number of records (around 16 bytes per record) and
+    doesn't depend on the values of ids. Records beyond 4 GiB of the file are
+    not indexed.
+
+    Appending is serialized by a file lock. Readers don't lock, an incomplete
+    record at the end of the file is ignored until it's completed (or
+    truncated by the next writer if the writing process died).
+    """
+
+    MAGIC = b'KOSCHEI-NEVRAS-1\n'
+    HEADER = struct.Struct('>IH')
+    MAX_OFFSET = 0xFFFFFFFF
+    # number of records compared with the database by validate
+    VALIDATION_SAMPLE = 64
+
+    def __init__(self, directory, name='nevras', log=None):
+        self.log = log or logging.getLogger('koschei.nevra_dict.NevraDict')
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.name = name
+        self.path = os.path.join(directory, name)
+        with FileLock(directory, name):
+            self._open()
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.file = os.fdopen(fd, 'r+b', buffering=0)
+        size = os.fstat(fd).st_size
+        magic = self.file.read(len(self.MAGIC))
+        if magic != self.MAGIC:
+            if size:
+                self.log.warning("Unknown format of {}, discarding".format(self.path))
+            self.file.truncate(0)
+            self.file.write(self.MAGIC)
+        self._reset_index()
+
+    def _reset_index(self):
+        self.map = None
+        self.offset = len(self.MAGIC)
+        self.last_record = None
+        self.count = 0
+        # hash tables of record offsets keyed by payload and by id, 0 means
+        # empty slot
+        self.slots = array('I', bytes(4 * 1024))
+        self.slots_by_id = array('I', bytes(4 * 1024))
+
+    def close(self):
+        if self.map:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    @staticmethod
+    def encode(nevra):
+        name, epoch, version, release, arch = nevra
+        epoch = '' if epoch is None else str(epoch)
+        return '\0'.join((name, epoch, version, release, arch)).encode()
+
+    @staticmethod
+    def decode(payload):
+        name, epoch, version, release, arch = payload.decode().split('\0')
+        return name, int(epoch) if epoch else None, version, release, arch
+
+    def _record(self, offset):
+        dep_id, length = self.HEADER.unpack_from(self.map, offset)
+        start = offset + self.HEADER.size
+        return dep_id, self.map[start:start + length]
+
+    def _probe(self, slots, field, key):
+        """
+        Returns the slot index in which a record with given key is or should
+        be stored.
+
+        :param slots: hash table to probe
+        :param field: index of the key in the record (0 for id, 1 for payload)
+        """
+        mask = len(slots) - 1
+        i = hash(key) & mask
+        while True:
+            offset = slots[i]
+            if not offset or self._record(offset)[field] == key:
+                return i
+            i = (i + 1) & mask
+
+    def _grow(self):
+        offsets = [offset for offset in self.slots if offset]
+        size = len(self.slots) * 2
+        self.slots = array('I', bytes(4 * size))
+        self.slots_by_id = array('I', bytes(4 * size))
+        for offset in offsets:
+            dep_id, payload = self._record(offset)
+            self.slots[self._probe(self.slots, 1, payload)] = offset
+            self.slots_by_id[self._probe(self.slots_by_id, 0, dep_id)] = offset
+
+    def _index(self, offset, dep_id, payload):
+        if (self.count + 1) * 2 > len(self.slots):
+            self._grow()
+        slot = self._probe(self.slots, 1, payload)
+        if not self.slots[slot]:
+            self.count += 1
+        self.slots[slot] = offset
+        self.slots_by_id[self._probe(self.slots_by_id, 0, dep_id)] = offset
+        self.last_record = offset
+
+    def refresh(self, locked=False):
+        """
+        Indexes records appended since the last refresh.
+
+        :param locked: whether the caller holds the file lock
+        """
+        try:
+            replaced = os.stat(self.path).st_ino != os.fstat(self.file.fileno()).st_ino
+        except FileNotFoundError:
+            replaced = True
+        if replaced:
+            # the file was discarded by another process
+            self.close()
+            if locked:
+                self._open()
+            else:
+                with FileLock(self.directory, self.name):
+                    self._open()
+        size = os.fstat(self.file.fileno()).st_size
+        if size <= self.offset:
+            return
+        if self.map:
+            self.map.close()
+        self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+        offset = self.offset
+        while offset + self.HEADER.size <= size:
+            dep_id, length = self.HEADER.unpack_from(self.map, offset)
+            end = offset + self.HEADER.size + length
+            if end > size or offset > self.MAX_OFFSET:
+                break
+            self._index(offset, dep_id, self.map[end - length:end])
+            offset = end
+        self.offset = offset
+
+    def get_id(self, nevra):
+        """
+        Returns id of given NEVRA or None if it's not known.
+        """
+        if not self.count:
+            return None
+        offset = self.slots[self._probe(self.slots, 1, self.encode(nevra))]
+        if offset:
+            return self._record(offset)[0]
+        return None
+
+    def get_nevra(self, dep_id):
+        """
+        Returns NEVRA with given id or None if it's not known.
+        """
+        if not self.count:
+            return None
+        offset = self.slots_by_id[self._probe(self.slots_by_id, 0, dep_id)]
+        if offset:
+            return self.decode(self._record(offset)[1])
+        return None
+
+    def add(self, deps):
+        """
+        Appends given dependencies (tuples of id, name, epoch, version,
+        release, arch) which are not yet present. The dependency rows must be
+        committed.
+        """
+        with FileLock(self.directory, self.name):
+            self.refresh(locked=True)
+            data = []
+            for dep in set(deps):
+                if self.get_id(dep[1:]) is None:
+                    payload = self.encode(dep[1:])
+                    data.append(self.HEADER.pack(dep[0], len(payload)))
+                    data.append(payload)
+            if data:
+                # drop incomplete record left by a writer that died
+                self.file.truncate(self.offset)
+                self.file.seek(self.offset)
+                self.file.write(b''.join(data))
+            self.refresh(locked=True)
+
+    def validate(self, query_fn):
+        """
+        Checks a sample of records (the first, the last and records spread
+        over the whole file) against the database and discards the file if
+        they don't match (i.e. the database was recreated).
+
+        :param query_fn: function returning dependency rows with given ids
+        """
+        self.refresh()
+        if not self.count:
+            return
+        offsets = [offset for offset in self.slots if offset]
+        step = max(1, len(offsets) // self.VALIDATION_SAMPLE)
+        sample = offsets[::step] + [len(self.MAGIC), self.last_record]
+        records = {}
+        for offset in sample:
+            dep_id, payload = self._record(offset)
+            records[dep_id] = self.decode(payload)
+        rows = {row[0]: tuple(row[1:]) for row in query_fn(list(records))}
+        if rows != records:
+            self.log.warning("{} doesn't match the database, discarding"
+                             .format(self.path))
+            with FileLock(self.directory, self.name):
+                os.unlink(self.path)
+                self.close()
+                self._open()
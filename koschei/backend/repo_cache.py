@@ -26,6 +26,8 @@ import logging
 import os
 import contextlib
 
+from collections import OrderedDict
+
 from koschei.config import get_config
 from koschei.backend import repo_util
 from koschei.backend.file_cache import FileCache
@@ -47,9 +49,19 @@ class RepoCache(FileCache):
         super(RepoCache, self).__init__(
             cachedir=self.cachedir,
             capacity=get_config('dependency.cache_l2_capacity'),
+            capacity_bytes=get_config('dependency.cache_l2_capacity_bytes'),
             log=self.log,
+            # deduplicated repodata files are also linked from the object
+            # directory, which has no budget of its own
+            external_links=1 if repo_util.get_objects_dir() else 0,
         )
         self.locked = []
+        # L1 cache of loaded sacks, in LRU order. Maps repo descriptors to
+        # (ExitStack holding the read lock, sack, estimated size in bytes)
+        self.resident = OrderedDict()
+        self.resident_capacity = get_config('dependency.cache_l1_capacity')
+        memory_limit = get_config('dependency.cache_l1_memory_limit')
+        self.resident_memory_limit = memory_limit and memory_limit * 1024 * 1024
 
     # @Override
     def read_item(self, repo_descriptor, cachedir):
@@ -80,13 +92,84 @@ class RepoCache(FileCache):
     def get_sack(self, repo_descriptor):
         """
         Returns a hawkey.Sack for given repo while holding read lock on it.
+        With L1 cache enabled, the sack stays loaded (and the repo read
+        locked) after it's released, until it's evicted.
         """
         assert repo_descriptor not in self.locked
-        with self.get_item(repo_descriptor) as sack:
-            self.locked.append(repo_descriptor)
+        if not self.resident_capacity:
+            with self.get_item(repo_descriptor) as sack:
+                self.locked.append(repo_descriptor)
+                yield sack
+                self.locked.remove(repo_descriptor)
+            return
+        sack = self._get_resident_sack(repo_descriptor)
+        self.locked.append(repo_descriptor)
+        try:
             yield sack
+        finally:
             self.locked.remove(repo_descriptor)
 
+    def _get_resident_sack(self, repo_descriptor):
+        entry = self.resident.get(repo_descriptor)
+        if entry:
+            self.resident.move_to_end(repo_descriptor)
+            # keep the L2 LRU order up-to-date for other processes
+            self.touch(repo_descriptor)
+            return entry[1]
+        stack = contextlib.ExitStack()
+        memory_before = self._resident_memory()
+        sack = stack.enter_context(self.get_item(repo_descriptor))
+        if not sack:
+            stack.close()
+            return sack
+        size = max(0, self._resident_memory() - memory_before)
+        self.resident[repo_descriptor] = stack, sack, size
+        self._evict_resident(exclude=repo_descriptor)
+        return sack
+
+    def _evict_resident(self, exclude):
+        """
+        Evicts least recently used sacks which are not in use until the L1
+        cache fits into its limits. Releases read locks of evicted repos.
+        """
+        def over_limit():
+            if len(self.resident) > self.resident_capacity:
+                return True
+            if self.resident_memory_limit:
+                total = sum(size for _, _, size in self.resident.values())
+                return total > self.resident_memory_limit
+            return False
+
+        for repo_descriptor in list(self.resident):
+            if not over_limit():
+                break
+            if repo_descriptor == exclude or repo_descriptor in self.locked:
+                continue
+            stack, _, _ = self.resident.pop(repo_descriptor)
+            self.log.debug('Evicting sack of repo {}'.format(repo_descriptor))
+            stack.close()
+
+    @staticmethod
+    def _resident_memory():
+        """
+        Returns resident memory of the process in bytes. Used to estimate
+        memory consumed by a sack.
+        """
+        try:
+            with open('/proc/self/statm') as statm_f:
+                resident = int(statm_f.readline().split()[1])
+        except (OSError, IndexError, ValueError):
+            return 0
+        return resident * os.sysconf('SC_PAGE_SIZE')
+
+    def clear_resident(self):
+        """
+        Drops all sacks from L1 cache and releases their read locks.
+        """
+        for stack, _, _ in self.resident.values():
+            stack.close()
+        self.resident.clear()
+
     def get_sack_copy(self, repo_descriptor):
         """
         Gets a copy of a sack, for which a lock is already held.
@@ -22,10 +22,97 @@ Utility functions for downloading repos.
 
 import os
 import hawkey
+import logging
 import librepo
 import shutil
 
+from koschei import util
 from koschei.config import get_config
+from koschei.backend.depsolve import Sack, FileProvides
+
+
+def get_objects_dir():
+    """
+    Returns path to the directory of content-addressed repodata files, or
+    None if deduplication of repodata is disabled.
+    """
+    if not get_config('dependency.deduplicate_repodata'):
+        return None
+    return os.path.join(get_config('directories.cachedir'), 'repodata-objects')
+
+
+def _object_path(objects_dir, record):
+    return os.path.join(objects_dir, record['checksum_type'], record['checksum'])
+
+
+def link_object(objects_dir, record, repo_path):
+    """
+    Hardlinks the metadata file described by given repomd record from the
+    object directory into the repo, if it's present there.
+
+    :returns: whether the file was linked
+    """
+    target = os.path.join(repo_path, record['location_href'])
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(_object_path(objects_dir, record), target)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def store_object(objects_dir, record, repo_path):
+    """
+    Hardlinks a downloaded metadata file described by given repomd record
+    into the object directory.
+    """
+    object_path = _object_path(objects_dir, record)
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(object_path, os.getpid())
+    os.link(os.path.join(repo_path, record['location_href']), tmp_path)
+    os.replace(tmp_path, object_path)
+
+
+def remove_unreferenced_objects(objects_dir):
+    """
+    Removes files from the object directory that are not linked from any
+    repo anymore.
+    """
+    for dirpath, _, filenames in os.walk(objects_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                if os.stat(path).st_nlink == 1:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def download_deduplicated(h, repo_path, objects_dir):
+    """
+    Downloads repo using given librepo handle, but only the metadata files
+    whose content isn't already present in the object directory. The other
+    files are hardlinked from there. Newly downloaded files are added to the
+    object directory. Files are identified by their checksums from
+    repomd.xml.
+    """
+    remove_unreferenced_objects(objects_dir)
+    md_types = h.yumdlist
+    # repomd.xml only
+    h.yumdlist = []
+    result = h.perform(librepo.Result())
+    records = result.rpmmd_repomd['records']
+    missing = [
+        md_type for md_type in md_types
+        if md_type in records and not link_object(objects_dir, records[md_type],
+                                                  repo_path)
+    ]
+    if missing:
+        h.yumdlist = missing
+        h.update = True
+        h.perform(result)
+    for md_type in missing:
+        store_object(objects_dir, records[md_type], repo_path)
 
 
 def get_repo(repo_dir, repo_descriptor, download=False):
@@ -39,6 +126,7 @@ def get_repo(repo_dir, repo_descriptor, download=False):
     """
     h = librepo.Handle()
     repo_path = os.path.join(repo_dir, str(repo_descriptor))
+    objects_dir = download and get_objects_dir()
     if download:
         h.destdir = repo_path
         shutil.rmtree(repo_path, ignore_errors=True)
@@ -49,6 +137,10 @@ def get_repo(repo_dir, repo_descriptor, download=False):
     h.yumdlist = ['primary', 'filelists', 'group', 'group_gz']
     result = librepo.Result()
     try:
+        if objects_dir:
+            download_deduplicated(h, repo_path, objects_dir)
+            # load the complete repo from disk
+            return get_repo(repo_dir, repo_descriptor)
         result = h.perform(result)
     except librepo.LibrepoException as e:
         if e.args[0] == librepo.LRE_NOURL:
@@ -80,6 +172,39 @@ def get_comps_path(repo_dir, repo_descriptor):
     return result.yum_repo.get('group')
 
 
+def prune_sack(sack, repo_descriptor):
+    """
+    Excludes packages that can never be installed into a buildroot from the
+    sack, according to dependency.sack_excludes configuration. Excluded
+    packages are skipped by all queries and by the solver. Packages that are
+    already excluded are not counted again, so it can be called again after
+    loading another repo into the sack.
+
+    :returns: number of newly excluded packages
+    """
+    excludes = get_config('dependency.sack_excludes')
+    considered = hawkey.Query(sack)
+    excluded = considered.filter(empty=True)
+    if excludes['arches']:
+        excluded = excluded.union(considered.filter(arch=excludes['arches']))
+    if excludes['incompatible_arches']:
+        compatible = sack.list_arches() + ['noarch']
+        excluded = excluded.union(considered.filter(arch__neq=compatible))
+    if excludes['names']:
+        excluded = excluded.union(considered.filter(name__glob=excludes['names']))
+    total = len(considered)
+    pruned = len(excluded)
+    if pruned:
+        sack.add_excludes(excluded)
+        sack.clear_caches()
+    log = logging.getLogger('koschei.backend.repo_util')
+    log.info(
+        'Excluded %d of %d packages from sack of repo %s',
+        pruned, total, repo_descriptor,
+    )
+    return pruned
+
+
 def load_sack(repo_dir, repo_descriptor, download=False):
     """
     Obtain hawkey Sack either by loading from disk, or downloading from
@@ -91,8 +216,27 @@ def load_sack(repo_dir, repo_descriptor, download=False):
     """
     cache_dir = os.path.join(repo_dir, str(repo_descriptor), 'cache')
     for_arch = get_config('dependency.resolve_for_arch')
-    sack = hawkey.Sack(arch=for_arch, cachedir=cache_dir)
+    sack = Sack(arch=for_arch, cachedir=cache_dir)
     repo = get_repo(repo_dir, repo_descriptor, download)
     if repo:
-        sack.load_repo(repo, load_filelists=True, build_cache=download)
+        if not get_config('dependency.lazy_filelists'):
+            sack.load_repo(repo, load_filelists=True, build_cache=download)
+            prune_sack(sack, repo_descriptor)
+            return sack
+
+        def load_full_sack(build_cache=False):
+            full_sack = hawkey.Sack(arch=for_arch, cachedir=cache_dir)
+            full_sack.load_repo(repo, load_filelists=True, build_cache=build_cache)
+            return full_sack
+
+        def build_full_cache(_):
+            load_full_sack(build_cache=True)
+
+        if download:
+            # build the cache including filelists, so that later lookups don't
+            # need to parse them
+            util.run_in_process(build_full_cache, None)
+        sack.load_repo(repo, load_filelists=False, build_cache=download)
+        sack.file_provides = FileProvides(load_full_sack)
+        prune_sack(sack, repo_descriptor)
         return sack
@@ -69,20 +69,29 @@ class Service(object):
     def memory_check(self):
         """
         Check whether the process exceeds memory limits specified in configuration
-        (by default there is no limit). If it does, the process exits with code 3.
+        (by default there is no limit). If it does, sacks kept loaded by the repo
+        cache are dropped. If the limits are still exceeded, the process exits with
+        code 3.
         """
         resident_limit = self.service_config.get("memory_limit", None)
         virtual_limit = self.service_config.get("virtual_memory_limit", None)
         if resident_limit or virtual_limit:
-            # see man 5 proc, search for statm
-            with open('/proc/self/statm') as statm_f:
-                statm = statm_f.readline().split()
-            page_size = os.sysconf("SC_PAGE_SIZE") / 1024
-            virtual, resident = [int(pages) * page_size for pages in statm[0:2]]
-            if (
+            def over_limit():
+                # see man 5 proc, search for statm
+                with open('/proc/self/statm') as statm_f:
+                    statm = statm_f.readline().split()
+                page_size = os.sysconf("SC_PAGE_SIZE") / 1024
+                virtual, resident = [int(pages) * page_size for pages in statm[0:2]]
+                exceeded = (
                     (resident_limit and resident > resident_limit) or
                     (virtual_limit and virtual > virtual_limit)
-            ):
+                )
+                return exceeded, virtual, resident
+
+            exceeded, virtual, resident = over_limit()
+            if exceeded and self.session.clear_resident_sacks():
+                exceeded, virtual, resident = over_limit()
+            if exceeded:
                 self.log.info("Memory limit reached - resident: {resident} KiB, "
                               "virtual: {virtual} KiB. Exiting."
                               .format(virtual=virtual, resident=resident))
@@ -17,11 +17,15 @@
 # Author: Michael Simacek <msimacek@redhat.com>
 # Author: Mikolaj Izdebski <mizdebsk@redhat.com>
 
+import contextlib
+import multiprocessing
+
 from itertools import groupby
 
 from sqlalchemy.sql import insert
 from sqlalchemy.orm.exc import ObjectDeletedError, StaleDataError
 
+from koschei import util
 from koschei.config import get_config
 from koschei.locks import pg_session_lock, Locked, LOCK_BUILD_RESOLVER
 from koschei.models import (
@@ -31,11 +35,55 @@ from koschei.models import (
 from koschei.backend.services.resolver import Resolver
 
 
+class PrevBuilds(object):
+    """
+    Builds against which dependencies of a group of builds are compared.
+    Previous builds are prefetched for the whole group, builds resolved while
+    processing the group take precedence over them.
+    """
+    def __init__(self, prefetched):
+        # build id -> previous build
+        self.prefetched = prefetched
+        # package id -> latest build resolved while processing the group
+        self.resolved = {}
+
+    def get(self, build):
+        """
+        Returns the build that given build should be compared against, or None.
+        """
+        prev_build = self.prefetched.get(build.id)
+        latest = self.resolved.get(build.package_id)
+        if (
+                latest is not None and
+                latest.started < build.started and
+                (prev_build is None or latest.started > prev_build.started)
+        ):
+            return latest
+        return prev_build
+
+    def add(self, build):
+        """
+        Records a successfully resolved build.
+        """
+        latest = self.resolved.get(build.package_id)
+        if latest is None or latest.started < build.started:
+            self.resolved[build.package_id] = build
+
+    def checkpoint(self):
+        return dict(self.resolved)
+
+    def restore(self, checkpoint):
+        self.resolved = checkpoint
+
+
 class BuildResolver(Resolver):
     """
     Service for processing dependencies of builds.
     """
 
+    # shared by worker processes, see process_repo_ids_parallel
+    sack_slots = None
+
     def main(self):
         """
         Service entry-point. Processes builds in all collections.
@@ -50,15 +98,7 @@ class BuildResolver(Resolver):
         always processes one repo ID.
         Commits the transaction in increments.
         """
-        builds = (
-            self.db.query(Build)
-            .join(Build.package)
-            .filter(Build.deps_resolved == None)
-            .filter(Build.repo_id != None)
-            .filter(Package.collection_id == collection.id)
-            .order_by(Build.repo_id)
-            .all()
-        )
+        builds = self.get_unprocessed_builds(collection)
 
         if not builds:
             self.log.debug("No builds to process for collection %s", collection)
@@ -66,15 +106,128 @@ class BuildResolver(Resolver):
 
         self.log.info("Processing %d builds for collection %s", len(builds), collection)
 
+        workers = get_config('dependency.build_resolver_workers')
+        if workers > 1:
+            repo_ids = sorted({build.repo_id for build in builds})
+            self.process_repo_ids_parallel(collection, repo_ids, workers)
+            return
+
         # Group by repo_id to speed up processing (reuse the sack)
         for repo_id, builds_group in groupby(builds, lambda b: b.repo_id):
-            builds_group = list(builds_group)
-            try:
-                with pg_session_lock(self.db, LOCK_BUILD_RESOLVER, repo_id, block=False):
-                    self.process_builds_with_repo_id(collection, repo_id, builds_group)
-                    self.db.commit()
-            except Locked:
-                continue
+            self.process_repo_id_group(collection, repo_id, list(builds_group))
+
+    def get_unprocessed_builds(self, collection, repo_id=None):
+        """
+        Returns builds in given collection (and optionally with given repo_id)
+        whose dependencies were not processed yet, ordered by repo_id and
+        start time.
+        """
+        query = (
+            self.db.query(Build)
+            .join(Build.package)
+            .filter(Build.deps_resolved == None)
+            .filter(Build.repo_id != None)
+            .filter(Package.collection_id == collection.id)
+        )
+        if repo_id is not None:
+            query = query.filter(Build.repo_id == repo_id)
+        # builds of the same package need to be processed in order
+        return query.order_by(Build.repo_id, Build.started).all()
+
+    def process_repo_id_group(self, collection, repo_id, builds):
+        """
+        Processes given builds with the same repo_id, unless the repo_id is
+        being processed by another process.
+        Commits the transaction in increments.
+        """
+        try:
+            with pg_session_lock(self.db, LOCK_BUILD_RESOLVER, repo_id, block=False):
+                self.process_builds_with_repo_id(collection, repo_id, builds)
+                self.db.commit()
+        except Locked:
+            pass
+
+    def process_repo_ids_parallel(self, collection, repo_ids, workers):
+        """
+        Processes builds with given repo_ids in a pool of forked worker
+        processes. Each worker claims repo_ids from a shared queue and
+        processes them with its own database session and sack. The number of
+        sacks loaded at the same time is limited by
+        `dependency.build_resolver_memory_limit`.
+        """
+        ctx = multiprocessing.get_context('fork')
+        workers = min(workers, len(repo_ids))
+        repo_queue = ctx.SimpleQueue()
+        sack_slots = ctx.BoundedSemaphore(self.get_max_sacks(workers))
+        # the transaction cannot be shared with the workers
+        self.db.rollback()
+        processes = [
+            ctx.Process(
+                target=self.worker_fn,
+                args=(collection.id, repo_queue, sack_slots),
+                daemon=True,
+            )
+            for _ in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        for repo_id in repo_ids:
+            repo_queue.put(repo_id)
+        for _ in processes:
+            repo_queue.put(None)
+        for process in processes:
+            process.join()
+        failed = sum(1 for process in processes if process.exitcode != 0)
+        if failed:
+            raise RuntimeError(
+                "{} of {} build resolver workers failed".format(failed, workers)
+            )
+
+    @staticmethod
+    def get_max_sacks(workers):
+        """
+        Returns the maximum number of sacks that may be loaded by the workers
+        at the same time.
+        """
+        memory_limit = get_config('dependency.build_resolver_memory_limit')
+        if not memory_limit:
+            return workers
+        sack_memory = get_config('dependency.build_resolver_sack_memory')
+        return max(1, min(workers, memory_limit // sack_memory))
+
+    def worker_fn(self, collection_id, repo_queue, sack_slots):
+        """
+        Main function of a worker process started by
+        `process_repo_ids_parallel`. Processes repo_ids from the queue until
+        it gets None.
+        """
+        self.session.reset_after_fork()
+        # new service instance with a new database session and dependency
+        # cache. The NEVRA dictionary is shared through the cache directory
+        worker = type(self)(self.session)
+        worker.sack_slots = sack_slots
+        # a loaded sack must not outlive its slot
+        self.session.repo_cache.resident_capacity = 0
+        try:
+            collection = worker.db.query(Collection).get(collection_id)
+            for repo_id in iter(repo_queue.get, None):
+                builds = worker.get_unprocessed_builds(collection, repo_id)
+                if builds:
+                    worker.process_repo_id_group(collection, repo_id, builds)
+        except Exception:
+            worker.log.exception("Build resolver worker failed")
+            raise
+        finally:
+            self.session.close()
+
+    def sack_slot(self):
+        """
+        Returns a context manager that needs to be held while a sack is
+        loaded. Blocks when too many sacks are loaded by other workers.
+        """
+        if self.sack_slots is None:
+            return contextlib.nullcontext()
+        return self.sack_slots
 
     def process_builds_with_repo_id(self, collection, repo_id, builds):
         """
@@ -95,7 +248,7 @@ class BuildResolver(Resolver):
             self.process_unresolved_builds(builds)
             return
 
-        with self.session.repo_cache.get_sack(descriptor) as sack:
+        with self.sack_slot(), self.session.repo_cache.get_sack(descriptor) as sack:
             if not sack:
                 self.log.info("Failed to obtain sack for repo ID %d", repo_id)
                 # The repo was not marked as deleted in Koji, so this is likely
@@ -103,25 +256,53 @@ class BuildResolver(Resolver):
                 return
             nvras = [b.srpm_nvra for b in builds]
             all_brs = self.get_rpm_requires(collection, nvras)
-            for build, brs in zip(builds, all_brs):
-                self.process_build(sack, build_group, build, brs)
+            prev_builds = PrevBuilds(self.get_prev_builds_for_comparison(builds))
+            batch_size = get_config('dependency.build_resolver_batch_size')
+            for batch in util.chunks(list(zip(builds, all_brs)), batch_size):
+                self.process_build_batch(sack, build_group, batch, prev_builds)
+
+    def process_build_batch(self, sack, build_group, batch, prev_builds):
+        """
+        Processes a list of (build, BuildRequires) pairs in given sack.
+        Commits the transaction once for the whole batch, without expiring the
+        previous builds prefetched for the following batches. If any of the
+        builds was deleted concurrently, the transaction is rolled back and
+        the builds are processed again one by one, so that only the deleted
+        build is skipped.
+        """
+        checkpoint = prev_builds.checkpoint()
+        try:
+            for build, brs in batch:
+                self.process_build(sack, build_group, build, brs, prev_builds)
+            self.db.commit_no_expire()
+        except (StaleDataError, ObjectDeletedError):
+            self.db.rollback()
+            prev_builds.restore(checkpoint)
+            if len(batch) > 1:
+                for entry in batch:
+                    self.process_build_batch(sack, build_group, [entry], prev_builds)
+            # otherwise the build was deleted concurrently, can be skipped
 
-    def process_build(self, sack, build_group, build, brs):
+    def process_build(self, sack, build_group, build, brs, prev_builds):
         """
         Processes single build in given sack.
-        Commits the transaction.
+        Doesn't commit the transaction.
         """
         self.log.info("Processing %s", build)
-        try:
+        # the same BuildRequires may have been already resolved in this repo
+        # by repo resolver
+        curr_deps_by_id = self.get_resolution_result(
+            build.package.collection_id, build.repo_id, brs, build_group,
+        )
+        if curr_deps_by_id is None:
             resolved, _, installs = self.resolve_dependencies(sack, brs, build_group)
             if not resolved:
                 self.process_unresolved_build(build)
-            else:
-                self.process_resolved_build(build, installs)
-            self.db.commit()
-        except (StaleDataError, ObjectDeletedError):
-            # build deleted concurrently, can be skipped
-            self.db.rollback()
+                return
+            curr_deps_by_id = self.get_dependency_ids(
+                [install for install in installs if install.arch != 'src']
+            )
+        self.process_resolved_build(build, curr_deps_by_id, prev_builds)
 
     def process_unresolved_builds(self, builds):
         """
@@ -142,44 +323,25 @@ class BuildResolver(Resolver):
         if build.package.last_build_id == build.id:
             build.package.build_priority = get_config('priorities.newly_added')
 
-    def process_resolved_build(self, build, curr_deps):
+    def process_resolved_build(self, build, curr_deps_by_id, prev_builds):
         """
         Processes a single build that resolved suceessfully.
         That entails marking it as resolved, storing the dependencies and
         dependency changes.
+
+        :param: curr_deps_by_id dependencies of the build, as returned by
+                                get_dependency_ids
         """
         build.deps_resolved = True
-        self.store_dependencies(build, curr_deps)
-        prev_build = self.get_prev_build_for_comparison(build)
+        build.dependency_keys = list(curr_deps_by_id)
+        prev_build = prev_builds.get(build)
+        prev_builds.add(build)
         if prev_build and prev_build.deps_resolved:
-            prev_deps = self.get_build_dependencies(prev_build)
-            if prev_deps is not None:
-                changes = self.create_dependency_changes(
-                    prev_deps, curr_deps,
+            if prev_build.dependency_keys is not None:
+                changes = self.create_dependency_changes_from_keys(
+                    prev_build.dependency_keys, curr_deps_by_id,
                     build_id=build.id,
                 )
                 if changes:
                     self.db.execute(insert(AppliedChange, changes))
             prev_build.dependency_keys = None
-
-    def store_dependencies(self, build, installs):
-        """
-        Stores a list of dependencies (output of hawkey.Goal.list_installs)
-        as dependencies of given build.
-        """
-        dep_tuples = [
-            (
-                install.name, install.epoch, install.version, install.release,
-                install.arch,
-            ) for install in installs
-            if install.arch != 'src'
-        ]
-        deps = self.dependency_cache.get_or_create_nevras(dep_tuples)
-        build.dependency_keys = [dep.id for dep in deps]
-
-    def get_build_dependencies(self, build):
-        """
-        Fetches dependencies of a given build.
-        """
-        if build.dependency_keys:
-            return self.dependency_cache.get_by_ids(build.dependency_keys)
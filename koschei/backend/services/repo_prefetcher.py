@@ -0,0 +1,84 @@
+# Copyright (C) 2026  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from koschei.config import get_config
+from koschei.backend import koji_util
+from koschei.backend.service import Service
+from koschei.models import Collection, Build, Package
+
+
+class RepoPrefetcher(Service):
+    """
+    Service for downloading repos into the repo cache before resolvers need
+    them. Watches for new Koji repos of all collections and for repos of
+    builds waiting to be processed by build resolver.
+    """
+
+    def main(self):
+        for collection in self.db.query(Collection).all():
+            self.prefetch_latest_repo(collection)
+        for collection in self.db.query(Collection).all():
+            self.prefetch_build_repos(collection)
+        self.db.rollback()
+
+    def prefetch_latest_repo(self, collection):
+        """
+        Prefetches latest Koji repo of given collection, if it's newer than
+        the one that was resolved last.
+        """
+        latest_repo = koji_util.get_latest_repo(
+            self.session.secondary_koji_for(collection),
+            collection.build_tag,
+        )
+        if latest_repo and (not collection.latest_repo_id or
+                            latest_repo['id'] > collection.latest_repo_id):
+            self.prefetch(collection, latest_repo['id'])
+
+    def prefetch_build_repos(self, collection):
+        """
+        Prefetches repos of builds waiting for build resolver, newest first.
+        The number of repos is limited by `dependency.prefetch_build_repos`,
+        so that the prefetched repos don't evict each other from the cache.
+        """
+        limit = get_config('dependency.prefetch_build_repos')
+        if not limit:
+            return
+        repo_ids = (
+            self.db.query(Build.repo_id)
+            .join(Build.package)
+            .filter(Build.deps_resolved == None)
+            .filter(Build.repo_id != None)
+            .filter(Package.collection_id == collection.id)
+            .distinct()
+            .order_by(Build.repo_id.desc())
+            .limit(limit)
+            .all()
+        )
+        for [repo_id] in repo_ids:
+            self.prefetch(collection, repo_id)
+
+    def prefetch(self, collection, repo_id):
+        descriptor = koji_util.create_repo_descriptor(
+            self.session.secondary_koji_for(collection),
+            repo_id,
+        )
+        if not descriptor:
+            self.log.debug("Repo %d is dead, not prefetching", repo_id)
+            return
+        # released before prefetching, which may take long
+        self.db.rollback()
+        if not self.session.repo_cache.prefetch(descriptor):
+            self.log.info("Failed to prefetch repo %s", descriptor)
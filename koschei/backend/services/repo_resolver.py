@@ -19,26 +19,30 @@
 
 import contextlib
 
+import hawkey
 import koji
 import time
 
-from collections import namedtuple
+from array import array
+from collections import namedtuple, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from queue import Queue
 
 from sqlalchemy.orm import joinedload, undefer
-from sqlalchemy.sql import insert
+from sqlalchemy.sql import insert, update, bindparam
 
 from koschei import util, backend
 from koschei.config import get_config
-from koschei.backend import koji_util
+from koschei.backend import koji_util, depsolve
 from koschei.plugin import dispatch_event
 from koschei.util import stopwatch
 from koschei.locks import pg_session_lock, Locked, LOCK_REPO_RESOLVER
 from koschei.models import (
     Package, UnappliedChange, ResolutionProblem, BuildrootProblem, RepoMapping,
-    ResolutionChange, Collection,
+    ResolutionChange, Collection, Build, ResolutionResult,
 )
 
-from koschei.backend.services.resolver import Resolver, total_time
+from koschei.backend.services.resolver import Resolver, total_time, fingerprint
 
 
 class RepoGenerationException(Exception):
@@ -51,7 +55,244 @@ ResolutionOutput = namedtuple(
 )
 
 
+class IncrementalState(object):
+    """
+    Snapshot of the last package resolution pass of a collection. Used to skip
+    packages whose resolution cannot be affected by the difference between the
+    previously resolved repo and the new one.
+
+    A package is considered affected when a binary package whose NEVRA changed
+    has the name of a package that was in its install set or that matched its
+    BuildRequires, or it provides something that any of its BuildRequires or
+    requires of a package from its install set refer to. Requires are matched
+    by name only and the matching is only as good as the recorded names (i.e.
+    a change of obsoletes or conflicts is not detected), so a full pass is
+    still forced periodically. The state is kept only in memory, so the first
+    pass after restart is always a full one.
+    """
+    def __init__(self, repo_id, build_group, sack_nevras):
+        self.repo_id = repo_id
+        self.build_group = build_group
+        self.sack_nevras = sack_nevras
+        self.incremental_passes = 0
+        # interned package names, install sets are stored as arrays of their ids
+        self.name_ids = {}
+        # package_id -> (last_build_id, buildrequires hash, array of name ids)
+        self.packages = {}
+        # names of provides of packages that changed in the current pass
+        self.changed_provides = set()
+
+    @staticmethod
+    def get_sack_nevras(sack):
+        return frozenset((pkg.name, pkg.evr, pkg.arch) for pkg in hawkey.Query(sack))
+
+    def get_changed_name_ids(self, sack, sack_nevras):
+        """
+        Returns ids of names of packages that changed between the state's sack
+        and given one, or that require anything provided by packages that are
+        new or changed in given sack. Records names of those provides to be
+        matched against BuildRequires.
+        """
+        changed = self.sack_nevras.symmetric_difference(sack_nevras)
+        changed_names = {name for name, _, _ in changed}
+        provides = [
+            reldep
+            for pkg in hawkey.Query(sack).filter(name=list(changed_names))
+            if (pkg.name, pkg.evr, pkg.arch) in changed
+            for reldep in pkg.provides
+        ] if changed_names else []
+        self.changed_provides = {
+            name for reldep in provides for name in depsolve.dep_names(reldep)
+        }
+        if provides:
+            # they may now be satisfied by a different provider
+            changed_names.update(
+                pkg.name for pkg in hawkey.Query(sack).filter(requires=provides)
+            )
+        return {
+            self.name_ids[name] for name in changed_names if name in self.name_ids
+        }
+
+    def record(self, package, br, names):
+        name_ids = self.name_ids
+        ids = sorted(name_ids.setdefault(name, len(name_ids)) for name in names)
+        self.packages[package.id] = (package.last_build_id, hash(tuple(br)),
+                                     array('I', ids))
+
+    def discard(self, package):
+        self.packages.pop(package.id, None)
+
+    def is_affected(self, package, br, changed_name_ids):
+        entry = self.packages.get(package.id)
+        if entry is None or package.resolved is not True:
+            return True
+        last_build_id, br_hash, name_ids = entry
+        if last_build_id != package.last_build_id or br_hash != hash(tuple(br)):
+            return True
+        if any(name_id in changed_name_ids for name_id in name_ids):
+            return True
+        return bool(self.changed_provides) and any(
+            not self.changed_provides.isdisjoint(depsolve.dep_names(dep))
+            for dep in br
+        )
+
+
+class ResolutionProgress(object):
+    """
+    Tracks and periodically logs progress of package resolution pass.
+    """
+    def __init__(self, log, total):
+        self.log = log
+        self.total = total
+        self.done = 0
+        self.skipped = 0
+        self.memo_hits = 0
+        self.reported = 0
+        self.reported_at = time.time()
+
+    def report(self):
+        current_time = time.time()
+        time_diff = current_time - self.reported_at
+        if time_diff > get_config('dependency.perf_report_interval'):
+            processed = self.done + self.skipped
+            self.log.info(
+                "Resolution progress: resolved {} packages ({}%) ({} pkgs/min), "
+                "{} reused results of identical BuildRequires"
+                .format(
+                    self.done,
+                    int(processed / self.total * 100.0),
+                    int((self.done - self.reported) / time_diff * 60.0),
+                    self.memo_hits,
+                )
+            )
+            self.reported = self.done
+            self.reported_at = current_time
+
+    def report_totals(self, changed_name_ids):
+        if changed_name_ids is not None:
+            self.log.info(
+                "Incremental resolution: {} of {} packages affected by changes "
+                "of {} package names".format(
+                    self.total - self.skipped, self.total, len(changed_name_ids),
+                )
+            )
+        if self.memo_hits:
+            self.log.info(
+                "Reused resolution results of identical BuildRequires for {} "
+                "of {} packages".format(self.memo_hits, self.total)
+            )
+
+
+class ResolutionPool(object):
+    """
+    Resolves sets of BuildRequires for a whole resolution pass. Results are
+    memoized for the pass, up to `dependency.resolution_memo_size` most
+    recently used ones, so that identical sets of BuildRequires in different
+    chunks are resolved only once.
+
+    With more than one worker, resolution is done by a pool of worker
+    processes sharing the sack copy-on-write. The pool is forked once, when
+    the object is created, so it needs to be created before any other thread
+    is started. The sack must not change afterwards, except for file provides
+    looked up by the main process, which are sent to the workers together
+    with the BuildRequires that need them.
+    """
+    def __init__(self, resolver, sack, build_group):
+        self.resolver = resolver
+        self.sack = sack
+        self.build_group = build_group
+        self.memo = OrderedDict()
+        self.memo_size = get_config('dependency.resolution_memo_size')
+        self.queue_size = get_config('dependency.resolver_queue_size')
+        # number of resolutions done (i.e. not taken from the memo)
+        self.resolutions = 0
+        self.tasks = None
+        self.workers = None
+        workers = get_config('dependency.resolver_workers')
+        if workers > 1:
+            # the dependency graph is built before forking, so that it's not
+            # built by each worker separately
+            depsolve.get_dependency_graph(sack)
+            self.tasks = Queue()
+            self.workers = util.parallel_process_generator(
+                self._resolve_in_worker, iter(self.tasks.get, None),
+                workers=workers, queue_size=self.queue_size,
+            )
+
+    def _resolve(self, br):
+        return self.resolver.resolve_dependencies(self.sack, br, self.build_group)
+
+    def _resolve_in_worker(self, arg):
+        br, file_provides = arg
+        if file_provides:
+            self.sack.file_provides.names.update(file_provides)
+        return self._resolve(br)
+
+    def _get_file_provides(self, br):
+        file_provides = getattr(self.sack, 'file_provides', None)
+        if not file_provides:
+            return None
+        return {
+            dep: file_provides.names[dep] for dep in list(br) + self.build_group
+            if dep in file_provides.names
+        }
+
+    def resolve(self, items):
+        """
+        Generates pairs of (key, output of resolve_dependencies) for given
+        pairs of (key, BuildRequires), in arbitrary order. Needs to be
+        consumed completely before being called again.
+        """
+        memoized = []
+        pending = []
+        for key, br in items:
+            result = self.memo.get(key)
+            if result is None:
+                pending.append((key, br))
+            else:
+                self.memo.move_to_end(key)
+                memoized.append((key, result))
+        self.resolutions += len(pending)
+        if self.workers:
+            for key, br in pending:
+                self.tasks.put((key, (br, self._get_file_provides(br))))
+            results = (next(self.workers) for _ in pending)
+        else:
+            results = util.parallel_generator(
+                ((key, self._resolve(br)) for key, br in pending),
+                queue_size=self.queue_size,
+            )
+        yield from memoized
+        for key, result in results:
+            self.memo[key] = result
+            if len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+            yield key, result
+
+    def close(self, terminate=False):
+        if self.workers:
+            self.tasks.put(None)
+            if terminate:
+                self.workers.stop()
+            else:
+                for _ in self.workers:
+                    pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        self.close(terminate=exc_type is not None)
+
+
 class RepoResolver(Resolver):
+    def __init__(self, session):
+        super(RepoResolver, self).__init__(session)
+        # collection_id -> IncrementalState
+        self.incremental_states = {}
+        # futures of BuildRequires being fetched by generate_package_chunks
+        self.br_prefetch = None
+
     def main(self):
         for collection in self.db.query(Collection).all():
             try:
@@ -77,21 +318,33 @@ class RepoResolver(Resolver):
             total_time.reset()
             total_time.start()
             self.dependency_cache.clear_stats()
+            prev_repo_id = collection.latest_repo_id
             with self.prepared_repo(collection, repo_id) as sack:
                 self.resolve_repo(collection, repo_id, sack)
                 if collection.latest_repo_resolved:
-                    packages = self.get_packages(collection)
-                    self.resolve_packages(collection, repo_id, sack, packages)
+                    package_ids = self.get_package_ids(collection)
+                    self.resolve_packages(
+                        collection, repo_id, sack, package_ids,
+                        prev_repo_id=prev_repo_id,
+                    )
+                selector_stats = sack.selector_cache.get_stats()
             total_time.stop()
             total_time.display()
-            self.log.info("Dependency cache stats: %s", self.dependency_cache.get_stats())
+            self.log.info(
+                "Dependency cache stats: %s; selector cache stats: %s",
+                self.dependency_cache.get_stats(),
+                selector_stats,
+            )
         elif collection.latest_repo_resolved:
             # we don't have a new repo, but we can at least resolve new packages
-            new_packages = self.get_packages(collection, only_new=True)
-            if new_packages:
+            new_package_ids = self.get_package_ids(collection, only_new=True)
+            if new_package_ids:
                 repo_id = collection.latest_repo_id
                 with self.prepared_repo(collection, repo_id) as sack:
-                    self.resolve_packages(collection, repo_id, sack, new_packages)
+                    self.resolve_packages(
+                        collection, repo_id, sack, new_package_ids,
+                        prev_repo_id=repo_id,
+                    )
 
     def get_new_repo_id(self, collection):
         """
@@ -157,6 +410,13 @@ class RepoResolver(Resolver):
         self.db.query(BuildrootProblem)\
             .filter_by(collection_id=collection.id)\
             .delete()
+        if collection.latest_repo_id:
+            # keep results of the previous repo for builds that were still
+            # submitted against it
+            self.db.query(ResolutionResult)\
+                .filter_by(collection_id=collection.id)\
+                .filter(ResolutionResult.repo_id < collection.latest_repo_id)\
+                .delete()
         prev_state = collection.state_string
         collection.latest_repo_id = repo_id
         collection.latest_repo_resolved = resolved
@@ -171,38 +431,139 @@ class RepoResolver(Resolver):
         dispatch_event('collection_state_change', self.session,
                        collection=collection, prev_state=prev_state, new_state=new_state)
 
-    def get_packages(self, collection, only_new=False):
+    def get_package_ids(self, collection, only_new=False):
         """
-        Get packages eligible for resolution in new repo for given collection.
+        Get ids of packages eligible for resolution in new repo for given
+        collection. Ordered by package name, so that packages from the same
+        family (which often have the same BuildRequires) are close together.
 
         :param: collection collection for which packages are requested
         :param: only_new whether to consider only packages that weren't
                          resolved yet
         """
         query = (
-            self.db.query(Package)
+            self.db.query(Package.id)
             .filter(~Package.blocked)
             .filter(Package.tracked)
             .filter(~Package.skip_resolution)
             .filter(Package.collection_id == collection.id)
             .filter(Package.last_complete_build_id != None)
-            .options(joinedload(Package.last_build))
-            .options(undefer('last_build.dependency_keys'))
+            .order_by(Package.name)
         )
         if only_new:
             query = query.filter(Package.resolved == None)
-        return query.all()
+        return [package_id for [package_id] in query.all()]
+
+    def get_packages(self, package_ids):
+        """
+        Loads packages with given ids, together with their last builds and
+        their dependency keys.
+        """
+        packages = {
+            package.id: package for package in
+            self.db.query(Package)
+            .filter(Package.id.in_(package_ids))
+            .options(joinedload(Package.last_build))
+            .options(undefer('last_build.dependency_keys'))
+        }
+        # packages deleted in the meantime are skipped
+        return [packages[package_id] for package_id in package_ids
+                if package_id in packages]
+
+    def get_srpm_nvras(self, package_ids):
+        """
+        Returns a dict of package id -> SRPM NVRA of the package's last complete
+        build, without loading whole packages.
+        """
+        query = (
+            self.db.query(Package.id, Package.name, Build.version, Build.release)
+            .join(Build, Build.id == Package.last_complete_build_id)
+            .filter(Package.id.in_(package_ids))
+        )
+        return {
+            package_id: dict(name=name, version=version, release=release, arch='src')
+            for package_id, name, version, release in query
+        }
 
-    def resolve_packages(self, collection, repo_id, sack, packages):
+    def generate_package_chunks(self, collection, package_ids):
+        """
+        Generates pairs of (list of packages, list of their BuildRequires) for
+        chunks of packages with given ids.
+
+        BuildRequires are fetched from Koji by a background thread, which runs
+        up to `dependency.br_prefetch_depth` chunks ahead of the consumer, so
+        that resolution of a chunk overlaps with fetching of the following
+        ones. The consumer needs to call `wait_for_br_prefetch` before forking.
+        The database is accessed only from the calling thread, packages
+        themselves are loaded only when their chunk is consumed.
+        """
+        depth = get_config('dependency.br_prefetch_depth')
+        chunk_ids_iter = util.chunks(
+            package_ids, get_config('dependency.package_chunk_size'),
+        )
+
+        def fetch(nvras):
+            return list(self.get_rpm_requires(collection, nvras))
+
+        # Koji session is used only by the single fetching thread
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = deque()
+            self.br_prefetch = pending
+            try:
+                while True:
+                    while len(pending) <= depth:
+                        chunk_ids = next(chunk_ids_iter, None)
+                        if chunk_ids is None:
+                            break
+                        nvras = self.get_srpm_nvras(chunk_ids)
+                        chunk_ids = [i for i in chunk_ids if i in nvras]
+                        future = executor.submit(fetch, [nvras[i] for i in chunk_ids])
+                        pending.append((chunk_ids, nvras, future))
+                    if not pending:
+                        return
+                    chunk_ids, nvras, future = pending.popleft()
+                    brs_by_id = dict(zip(chunk_ids, future.result()))
+                    packages = self.get_packages(chunk_ids)
+                    # a build may have been registered since the prefetch
+                    stale = [p for p in packages if p.srpm_nvra != nvras[p.id]]
+                    if stale:
+                        brs = executor.submit(
+                            fetch, [p.srpm_nvra for p in stale]
+                        ).result()
+                        brs_by_id.update(zip((p.id for p in stale), brs))
+                    yield packages, [brs_by_id[p.id] for p in packages]
+            finally:
+                self.br_prefetch = None
+
+    def wait_for_br_prefetch(self):
         """
-        Generates new dependency changes for given packages
+        Waits until the thread fetching BuildRequires in the background is
+        idle. Must be called before forking - the child process would inherit
+        locks held by the thread in the middle of a Koji call, which would
+        never be released there.
+        """
+        if self.br_prefetch:
+            wait([future for _, _, future in self.br_prefetch])
+
+    def resolve_packages(self, collection, repo_id, sack, package_ids,
+                         prev_repo_id=None):
+        """
+        Generates new dependency changes for packages with given ids.
+        Packages are loaded and processed in chunks, so that memory
+        consumption doesn't depend on the number of packages.
         Commits data in increments.
+
+        :param: prev_repo_id repo_id against which the packages were resolved
+                             last time. Used for incremental resolution
         """
+        build_group = self.get_build_group(collection, repo_id)
+        if build_group is None:
+            raise RuntimeError(
+                f"No build group found for {collection.name} at repo_id {repo_id}"
+            )
 
-        # get buildrequires
-        brs = self.get_rpm_requires(
-            collection,
-            [p.srpm_nvra for p in packages],
+        state, changed_name_ids = self.get_incremental_state(
+            collection, repo_id, prev_repo_id, sack, build_group,
         )
 
         self.log.info(
@@ -210,72 +571,191 @@ class RepoResolver(Resolver):
             .format(
                 repo_id,
                 collection.name,
-                len(packages),
+                len(package_ids),
             )
         )
-        self.generate_dependency_changes(collection, repo_id, sack, packages, brs)
+        progress = ResolutionProgress(self.log, len(package_ids))
+        # the pool forks before generate_package_chunks starts its thread
+        with ResolutionPool(self, sack, build_group) as pool:
+            for packages, brs in self.generate_package_chunks(collection, package_ids):
+                self.generate_dependency_changes(
+                    sack, packages, brs, build_group,
+                    state=state, changed_name_ids=changed_name_ids,
+                    progress=progress, collection_id=collection.id,
+                    repo_id=repo_id, prev_repo_id=prev_repo_id, pool=pool,
+                )
+        progress.report_totals(changed_name_ids)
         self.db.commit()
+        if state:
+            self.incremental_states[collection.id] = state
 
-    def generate_dependency_changes(self, collection, repo_id, sack, packages, brs):
+    def get_incremental_state(self, collection, repo_id, prev_repo_id, sack,
+                              build_group):
+        """
+        Returns a pair of (IncrementalState, set of changed name ids) to be used
+        for resolution of given repo. The state is None if incremental resolution
+        is disabled. Changed name ids are None if all packages need to be
+        resolved.
+
+        The state is removed from the resolver and needs to be put back once the
+        resolution pass successfully finishes, so that an interrupted pass cannot
+        leave behind a state inconsistent with the database.
+        """
+        if not get_config('dependency.incremental_resolution'):
+            return None, None
+        state = self.incremental_states.pop(collection.id, None)
+        if prev_repo_id == repo_id:
+            # newly added packages in an already resolved repo
+            if state and state.repo_id == repo_id:
+                state.changed_provides = set()
+                return state, set()
+            return None, None
+        sack_nevras = IncrementalState.get_sack_nevras(sack)
+        full_resolution_interval = get_config('dependency.full_resolution_interval')
+        if (
+                state and
+                state.repo_id == prev_repo_id and
+                state.build_group == build_group and
+                state.incremental_passes < full_resolution_interval
+        ):
+            changed_name_ids = state.get_changed_name_ids(sack, sack_nevras)
+            state.incremental_passes += 1
+        else:
+            state = IncrementalState(repo_id, build_group, sack_nevras)
+            changed_name_ids = None
+        state.repo_id = repo_id
+        state.sack_nevras = sack_nevras
+        return state, changed_name_ids
+
+    def generate_dependency_changes(self, sack, packages, brs, build_group,
+                                    state=None, changed_name_ids=None,
+                                    progress=None, collection_id=None,
+                                    repo_id=None, prev_repo_id=None, pool=None):
         """
         Generates and persists dependency changes for given list of packages.
         Emits package state change events.
+
+        :param: state IncrementalState to be used and updated
+        :param: changed_name_ids name ids changed since the state's repo, None
+                                 if all packages should be resolved
+        :param: progress ResolutionProgress of the whole pass
+        :param: collection_id, repo_id identify the repo of the sack. When
+                                       given, resolution results are stored
+                                       for reuse by build resolver
+        :param: prev_repo_id repo_id of the state. Stored resolution results
+                             of packages skipped by incremental resolution
+                             are copied from it
+        :param: pool ResolutionPool of the whole pass, a new one is used if
+                     not given
         """
         # pylint:disable=too-many-locals
-        results = []
-
-        build_group = self.get_build_group(collection, repo_id)
-        if build_group is None:
-            raise RuntimeError(
-                f"No build group found for {collection.name} at repo_id {repo_id}"
-            )
-        gen = ((package, self.resolve_dependencies(sack, br, build_group))
-               for package, br in zip(packages, brs))
-        queue_size = get_config('dependency.resolver_queue_size')
-        gen = util.parallel_generator(gen, queue_size=queue_size)
-        pkgs_done = 0
-        pkgs_reported = 0
-        progres_reported_at = time.time()
-        for package, (resolved, curr_problems, curr_deps) in gen:
-            changes = []
-            if curr_deps is not None:
-                prev_build = self.get_build_for_comparison(package)
-                if prev_build and prev_build.dependency_keys:
-                    prev_deps = self.dependency_cache.get_by_ids(
-                        prev_build.dependency_keys
-                    )
-                    changes = self.create_dependency_changes(
-                        prev_deps, curr_deps, package_id=package.id,
-                    )
-            results.append(ResolutionOutput(
-                package=package,
-                prev_resolved=package.resolved,
-                resolved=resolved,
-                problems=set(curr_problems),
-                changes=changes,
-                # last_build_id is used to detect concurrently registered builds
-                last_build_id=package.last_build_id,
-            ))
-            if len(results) > get_config('dependency.persist_chunk_size'):
-                self.persist_resolution_output(results)
-                results = []
-            pkgs_done += 1
-            current_time = time.time()
-            time_diff = current_time - progres_reported_at
-            if time_diff > get_config('dependency.perf_report_interval'):
-                self.log.info(
-                    "Resolution progress: resolved {} packages ({}%) ({} pkgs/min)"
-                    .format(
-                        pkgs_done,
-                        int(pkgs_done / len(packages) * 100.0),
-                        int((pkgs_done - pkgs_reported) / time_diff * 60.0)
+        if pool is None:
+            with ResolutionPool(self, sack, build_group) as pool:
+                return self.generate_dependency_changes(
+                    sack, packages, brs, build_group, state=state,
+                    changed_name_ids=changed_name_ids, progress=progress,
+                    collection_id=collection_id, repo_id=repo_id,
+                    prev_repo_id=prev_repo_id, pool=pool,
+                )
 
-                    )
+        results = []
+        store_results = (
+            repo_id is not None and
+            get_config('dependency.store_resolution_results')
+        )
+        resolution_results = []
+        if progress is None:
+            progress = ResolutionProgress(self.log, len(packages))
+
+        brs = list(brs)
+        if changed_name_ids is not None:
+            affected = []
+            skipped_hashes = set()
+            for package, br in zip(packages, brs):
+                if state.is_affected(package, br, changed_name_ids):
+                    affected.append((package, br))
+                else:
+                    skipped_hashes.add(fingerprint(br))
+            progress.skipped += len(packages) - len(affected)
+            packages = [package for package, _ in affected]
+            brs = [br for _, br in affected]
+            if store_results and prev_repo_id not in (None, repo_id):
+                # results of skipped packages are the same as in the previous
+                # repo, so that they can be reused by build resolver as well
+                self.copy_resolution_results(
+                    collection_id, prev_repo_id, repo_id, build_group,
+                    skipped_hashes,
                 )
-                pkgs_reported = pkgs_done
-                progres_reported_at = current_time
+
+        # Packages with the same set of BuildRequires have the same resolution
+        # result (the build group and the sack are the same for the whole
+        # pass), so each distinct set is resolved only once per pass
+        packages_by_br = {}
+        brs_by_key = {}
+        for package, br in zip(packages, brs):
+            key = tuple(sorted(set(br)))
+            packages_by_br.setdefault(key, []).append(package)
+            brs_by_key.setdefault(key, br)
+        # file dependencies missing from primary metadata are looked up in one
+        # filelists load for the whole chunk, before it's resolved in workers
+        depsolve.prefetch_file_provides(
+            sack, [dep for br in brs_by_key.values() for dep in br] + build_group,
+            before_fork=self.wait_for_br_prefetch,
+        )
+        resolutions = pool.resolutions
+        for key, (resolved, curr_problems, curr_deps) in pool.resolve(brs_by_key.items()):
+            br = brs_by_key[key]
+            names = None
+            if state and curr_deps is not None:
+                names = {dep.name for dep in curr_deps}
+                names.update(depsolve.get_provider_names(sack, br))
+            # pair of (deps_by_id, dependencies not in the database yet).
+            # Dependency rows are created only for dependencies that end up in
+            # changes
+            curr_ids = None
+            for package in packages_by_br[key]:
+                changes = []
+                if curr_deps is not None:
+                    prev_build = self.get_build_for_comparison(package)
+                    if prev_build and prev_build.dependency_keys:
+                        if curr_ids is None:
+                            curr_ids = self.find_dependency_ids(curr_deps)
+                        changes = self.create_dependency_changes_from_keys(
+                            prev_build.dependency_keys, *curr_ids,
+                            package_id=package.id,
+                        )
+                if state:
+                    if names is not None:
+                        state.record(package, br, names)
+                    else:
+                        state.discard(package)
+                results.append(ResolutionOutput(
+                    package=package,
+                    prev_resolved=package.resolved,
+                    resolved=resolved,
+                    problems=set(curr_problems),
+                    changes=changes,
+                    # last_build_id is used to detect concurrently registered builds
+                    last_build_id=package.last_build_id,
+                ))
+                if len(results) > get_config('dependency.persist_chunk_size'):
+                    self.persist_resolution_output(results)
+                    results = []
+                progress.done += 1
+            if store_results and curr_deps is not None:
+                if curr_ids is None or curr_ids[1]:
+                    curr_ids = self.find_dependency_ids(curr_deps)
+                # results with dependencies that weren't inserted aren't stored
+                if not curr_ids[1]:
+                    resolution_results.append((key, curr_ids[0]))
+            progress.report()
+        progress.memo_hits += len(packages) - (pool.resolutions - resolutions)
 
         self.persist_resolution_output(results)
+        if store_results:
+            self.store_resolution_results(
+                collection_id, repo_id, build_group, resolution_results,
+            )
 
     @stopwatch(total_time)
     def persist_resolution_output(self, chunk):
@@ -326,9 +806,9 @@ class RepoResolver(Resolver):
             .all()
         }
 
-        # dependency problems to be persisted
-        # format: [tuple(resolution change (orm objects), problems (strings))]
-        problem_entries = []
+        # resolution changes and their dependency problems to be persisted
+        # format: [tuple(resolution change (dict form), problems (strings))]
+        resolution_entries = []
         # dependency changes to be persisted
         dependency_changes = []
 
@@ -376,35 +856,45 @@ class RepoResolver(Resolver):
                         pkg_result.problems != previous_problems.get(package.id)
                     )
             ):
-                resolution_change = ResolutionChange(
-                    package_id=package.id,
-                    resolved=pkg_result.resolved,
+                resolution_entries.append(
+                    (dict(package_id=package.id, resolved=pkg_result.resolved),
+                     pkg_result.problems)
                 )
-                self.db.add(resolution_change)
-                problem_entries.append((resolution_change, pkg_result.problems))
-
-        # populate resolution changes' ids
-        self.db.flush()
-
-        # set problem resolution_ids and prepare dict form
-        to_insert = [
-            dict(resolution_id=resolution_change.id, problem=problem)
-            for resolution_change, problems in problem_entries
-            for problem in problems
-        ]
 
-        # insert dependency problems
-        if to_insert:
-            self.db.execute(insert(ResolutionProblem, to_insert))
-
-        # delete old dependency changes, they'll be replaced with new ones
-        self.db.query(UnappliedChange)\
-            .filter(UnappliedChange.package_id.in_(package_ids))\
-            .delete()
+        if resolution_entries:
+            # insert resolution changes, their ids are needed for problems
+            resolution_ids = dict(
+                self.db.execute(
+                    insert(
+                        ResolutionChange,
+                        [entry for entry, _ in resolution_entries],
+                        returning=(ResolutionChange.package_id, ResolutionChange.id),
+                    )
+                ).fetchall()
+            )
 
-        # insert dependency changes
-        if dependency_changes:
-            self.db.execute(insert(UnappliedChange, dependency_changes))
+            # set problem resolution_ids and prepare dict form
+            to_insert = [
+                dict(resolution_id=resolution_ids[entry['package_id']], problem=problem)
+                for entry, problems in resolution_entries
+                for problem in problems
+            ]
+
+            # insert dependency problems
+            if to_insert:
+                self.db.execute(insert(ResolutionProblem, to_insert))
+
+        if get_config('dependency.diff_unapplied_changes'):
+            self.update_unapplied_changes(package_ids, dependency_changes)
+        else:
+            # delete old dependency changes, they'll be replaced with new ones
+            self.db.query(UnappliedChange)\
+                .filter(UnappliedChange.package_id.in_(package_ids))\
+                .delete()
+
+            # insert dependency changes
+            if dependency_changes:
+                self.db.execute(insert(UnappliedChange, dependency_changes))
 
         self.db.commit_no_expire()
 
@@ -422,3 +912,47 @@ class RepoResolver(Resolver):
                     prev_state=prev_state,
                     new_state=new_state,
                 )
+
+    def update_unapplied_changes(self, package_ids, dependency_changes):
+        """
+        Replaces unapplied changes of given packages with given dependency
+        changes (in dict form). Only the difference to the current rows is
+        written - rows that stay the same are kept untouched.
+        """
+        existing = {
+            (change.package_id, change.prev_dep_id, change.curr_dep_id):
+            (change.id, change.distance)
+            for change in self.db.query(
+                UnappliedChange.id,
+                UnappliedChange.package_id,
+                UnappliedChange.prev_dep_id,
+                UnappliedChange.curr_dep_id,
+                UnappliedChange.distance,
+            )
+            .filter(UnappliedChange.package_id.in_(package_ids))
+        }
+        to_insert = []
+        to_update = []
+        for change in dependency_changes:
+            key = (change['package_id'], change['prev_dep_id'], change['curr_dep_id'])
+            current = existing.pop(key, None)
+            if current is None:
+                to_insert.append(change)
+            elif current[1] != change['distance']:
+                to_update.append(dict(
+                    change_id=current[0],
+                    new_distance=change['distance'],
+                ))
+        if existing:
+            self.db.query(UnappliedChange)\
+                .filter(UnappliedChange.id.in_([v[0] for v in existing.values()]))\
+                .delete(synchronize_session=False)
+        if to_update:
+            self.db.execute(
+                update(UnappliedChange)
+                .where(UnappliedChange.id == bindparam('change_id'))
+                .values(distance=bindparam('new_distance')),
+                to_update,
+            )
+        if to_insert:
+            self.db.execute(insert(UnappliedChange, to_insert))
@@ -17,17 +17,23 @@
 # Author: Michael Simacek <msimacek@redhat.com>
 # Author: Mikolaj Izdebski <mizdebsk@redhat.com>
 
-from collections import OrderedDict, namedtuple
+import hashlib
+import os
+import sys
 
-from sqlalchemy.orm import undefer
-from sqlalchemy.sql import insert
-from sqlalchemy.exc import IntegrityError
+from collections import namedtuple
+
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import aliased, undefer
+from sqlalchemy.sql import func, literal, tuple_
 
 from koschei import util
 from koschei.config import get_config
 from koschei.backend import koji_util, depsolve
+from koschei.backend.nevra_dict import NevraDict
 from koschei.backend.service import Service
-from koschei.models import Dependency, Build
+from koschei.models import Dependency, Build, ResolutionResult
 from koschei.util import Stopwatch, stopwatch
 
 total_time = Stopwatch("Total repo generation")
@@ -38,116 +44,320 @@ DepTuple = namedtuple(
 )
 
 
+def fingerprint(items):
+    """
+    Returns a fingerprint of given set of strings (i.e. BuildRequires or build
+    group), which doesn't depend on their order or duplicates.
+    """
+    return hashlib.sha256('\n'.join(sorted(set(items))).encode()).hexdigest()
+
+
+def dep_nevra(dep):
+    return dep.name, dep.epoch, dep.version, dep.release, dep.arch
+
+
 class DependencyCache(object):
-    def __init__(self, db, capacity):
+    """
+    In-process cache of dependency table rows. Optionally backed by a
+    NevraDict shared with other processes, which is consulted before querying
+    the database. Rows are added to the NevraDict only once they're known to
+    be committed - rows inserted by this cache are added after the session
+    commits.
+
+    Entries are stored in slots of parallel arrays (DepTuples with interned
+    strings and reference bits) and evicted using the clock algorithm -
+    accessing an entry only sets its reference bit.
+    The capacity can be limited by number of items and by (estimated) size in
+    bytes.
+    """
+    # estimated size of an entry excluding strings - the DepTuple, the NEVRA
+    # tuple, its slot in the arrays and entries in both index dicts
+    ENTRY_OVERHEAD = 300
+
+    def __init__(self, db, capacity, nevra_dict=None, capacity_bytes=None):
         self.db = db
         self.capacity = capacity
+        self.capacity_bytes = capacity_bytes
+        self.nevra_dict = nevra_dict
+        # slot storage
+        self.slot_deps = []
+        self.slot_refs = bytearray()
+        self.free_slots = []
+        self.clock_hand = 0
+        self.size = 0
+        # indices: id -> slot, nevra -> slot
+        self.ids = {}
         self.nevras = {}
-        self.ids = OrderedDict()
+        # rows inserted in current transaction
+        self.uncommitted = []
         self.hits = 0
+        self.shared_hits = 0
         self.misses = 0
         self.inserts = 0
+        if nevra_dict:
+            nevra_dict.validate(self._query_ids)
+            event.listen(db, 'after_commit', self._after_commit)
+            event.listen(db, 'after_rollback', self._after_rollback)
+
+    def _after_commit(self, _session):
+        if self.uncommitted:
+            self.nevra_dict.add(self.uncommitted)
+            self.uncommitted = []
+
+    def _after_rollback(self, _session):
+        for dep in self.uncommitted:
+            slot = self.ids.get(dep.id)
+            if slot is not None:
+                self._remove(slot)
+        self.uncommitted = []
+
+    def _publish(self, deps):
+        """
+        Adds rows obtained by querying the database to the shared NevraDict.
+        """
+        if self.nevra_dict and deps:
+            uncommitted = {dep.id for dep in self.uncommitted}
+            self.nevra_dict.add(dep for dep in deps if dep.id not in uncommitted)
 
     def clear_stats(self):
         self.hits = 0
+        self.shared_hits = 0
         self.misses = 0
         self.inserts = 0
 
     def get_stats(self):
         return ', '.join([
             f'hits={self.hits}',
+            f'shared_hits={self.shared_hits}',
             f'misses={self.misses}',
             f'inserts={self.inserts}',
             f'total_items={len(self.ids)}',
+            f'size={self.size}',
             f'capacity={self.capacity}',
+            f'capacity_bytes={self.capacity_bytes}',
         ])
 
+    def _entry_size(self, nevra):
+        name, _, version, release, arch = nevra
+        return (
+            self.ENTRY_OVERHEAD +
+            len(name) + len(version) + len(release) + len(arch)
+        )
+
+    def _is_full(self, size):
+        return (
+            len(self.ids) >= self.capacity or
+            (self.capacity_bytes is not None and
+             self.size + size > self.capacity_bytes)
+        )
+
+    def _get(self, slot):
+        self.slot_refs[slot] = 1
+        return self.slot_deps[slot]
+
     def _add(self, dep):
-        self.ids[dep.id] = dep
-        self.nevras[(dep.name, dep.epoch, dep.version, dep.release,
-                     dep.arch)] = dep
-        if len(self.ids) > self.capacity:
-            self._compact()
+        if dep.id in self.ids:
+            # duplicate ids in a single lookup, it's already in a slot
+            return
+        nevra = (
+            sys.intern(dep.name), dep.epoch, sys.intern(dep.version),
+            sys.intern(dep.release), sys.intern(dep.arch),
+        )
+        dep = DepTuple._make((dep.id,) + nevra)
+        size = self._entry_size(nevra)
+        while self.ids and self._is_full(size):
+            self._evict()
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.slot_deps[slot] = dep
+            self.slot_refs[slot] = 0
+        else:
+            slot = len(self.slot_deps)
+            self.slot_deps.append(dep)
+            self.slot_refs.append(0)
+        self.ids[dep.id] = slot
+        self.nevras[nevra] = slot
+        self.size += size
 
-    def _access(self, dep):
+    def _remove(self, slot):
+        dep = self.slot_deps[slot]
+        nevra = dep[1:]
         del self.ids[dep.id]
-        self.ids[dep.id] = dep
-
-    def _compact(self):
-        _, victim = self.ids.popitem(last=False)
-        # pylint: disable=no-member
-        del self.nevras[(victim.name, victim.epoch, victim.version,
-                         victim.release, victim.arch)]
-
-    def _get_or_create_nevra(self, nevra):
-        dep = self.nevras.get(nevra)
-        if dep is None:
-            dep = self.db.query(*Dependency.inevra)\
-                .filter((Dependency.name == nevra[0]) &
-                        (Dependency.epoch == nevra[1]) &
-                        (Dependency.version == nevra[2]) &
-                        (Dependency.release == nevra[3]) &
-                        (Dependency.arch == nevra[4]))\
-                .first()
-            if dep is None:
-                kwds = dict(name=nevra[0], epoch=nevra[1], version=nevra[2],
-                            release=nevra[3], arch=nevra[4])
-                dep_id = (
-                    self.db.execute(
-                        insert(
-                            Dependency,
-                            [kwds],
-                            returning=(Dependency.id,)
-                        )
-                    )
-                    .fetchone().id
-                )
-                dep = DepTuple(id=dep_id, **kwds)
-                self.inserts += 1
+        del self.nevras[nevra]
+        self.size -= self._entry_size(nevra)
+        self.slot_deps[slot] = None
+        self.free_slots.append(slot)
+
+    def _evict(self):
+        slot_count = len(self.slot_deps)
+        while True:
+            slot = self.clock_hand
+            self.clock_hand = (slot + 1) % slot_count
+            if self.slot_deps[slot] is None:
+                continue
+            if self.slot_refs[slot]:
+                self.slot_refs[slot] = 0
             else:
-                self.misses += 1
-            self._add(dep)
-        else:
-            self.hits += 1
-            self._access(dep)
-        return dep
+                self._remove(slot)
+                return
+
+    def _query_ids(self, ids):
+        return [
+            DepTuple(*dep) for dep in
+            self.db.query(*Dependency.inevra)
+            .filter(Dependency.id.in_(ids))
+            .all()
+        ]
+
+    def _query_nevras(self, nevras):
+        # NULL never compares equal in the tuple IN, so NEVRAs without epoch
+        # are looked up separately
+        with_epoch = [nevra for nevra in nevras if nevra[1] is not None]
+        without_epoch = [
+            (name, version, release, arch)
+            for name, epoch, version, release, arch in nevras if epoch is None
+        ]
+        deps = []
+        if with_epoch:
+            deps += self.db.query(*Dependency.inevra)\
+                .filter(tuple_(*Dependency.nevra).in_(with_epoch))\
+                .all()
+        if without_epoch:
+            deps += self.db.query(*Dependency.inevra)\
+                .filter(Dependency.epoch == None)\
+                .filter(tuple_(Dependency.name, Dependency.version,
+                               Dependency.release, Dependency.arch)
+                        .in_(without_epoch))\
+                .all()
+        return [DepTuple(*dep) for dep in deps]
+
+    def _insert_nevras(self, nevras):
+        rows = [
+            dict(name=name, epoch=epoch, version=version, release=release, arch=arch)
+            # consistent ordering to prevent deadlocks with concurrent inserts
+            for name, epoch, version, release, arch in sorted(nevras, key=str)
+        ]
+        return [
+            DepTuple(*dep) for dep in
+            self.db.execute(
+                pg_insert(Dependency)
+                .values(rows)
+                .on_conflict_do_nothing()
+                .returning(*Dependency.inevra)
+            )
+        ]
 
     def get_or_create_nevra(self, nevra):
-        try:
-            with self.db.begin_nested():
-                return self._get_or_create_nevra(nevra)
-        except IntegrityError:
-            # If there was a concurrent insert, the next query must succeed
-            return self._get_or_create_nevra(nevra)
+        return self.get_or_create_nevras([nevra])[0]
 
-    def get_or_create_nevras(self, nevras):
-        res = []
+    def _find_nevras(self, nevras):
+        """
+        Looks up given NEVRAs in the cache, the shared NevraDict and the
+        database. Returns a pair of a dict mapping found NEVRAs to DepTuples
+        and a set of NEVRAs that are not in the database.
+        """
+        found = {}
         for nevra in nevras:
-            res.append(self._get_or_create_nevra(nevra))
-        return res
+            if nevra not in found:
+                slot = self.nevras.get(nevra)
+                if slot is not None:
+                    self.hits += 1
+                    found[nevra] = self._get(slot)
+        missing = set(nevras).difference(found)
+        if missing and self.nevra_dict:
+            self.nevra_dict.refresh()
+            for nevra in missing:
+                dep_id = self.nevra_dict.get_id(nevra)
+                if dep_id is not None:
+                    self.shared_hits += 1
+                    found[nevra] = DepTuple(dep_id, *nevra)
+            missing.difference_update(found)
+        if missing:
+            deps = self._query_nevras(missing)
+            self.misses += len(deps)
+            for dep in deps:
+                found[dep[1:]] = dep
+            self._publish(deps)
+            missing.difference_update(found)
+        return found, missing
+
+    def _add_found(self, nevras, found):
+        for nevra in nevras:
+            if nevra in found and nevra not in self.nevras:
+                self._add(found[nevra])
+
+    @stopwatch(total_time, note='dependency cache')
+    def get_nevras(self, nevras):
+        """
+        Returns a dict mapping given NEVRAs to DepTuples. NEVRAs that are not
+        in the database are omitted, nothing is inserted.
+        """
+        found, _ = self._find_nevras(nevras)
+        self._add_found(nevras, found)
+        return found
+
+    @stopwatch(total_time, note='dependency cache')
+    def get_or_create_nevras(self, nevras):
+        """
+        Returns DepTuples for given list of NEVRAs (in the same order).
+        NEVRAs that are not in the cache are looked up using a single query,
+        the ones that are not in the database either are inserted using a
+        single insert.
+        """
+        found, not_found = self._find_nevras(nevras)
+        if not_found:
+            inserted = self._insert_nevras(not_found)
+            self.inserts += len(inserted)
+            self.uncommitted += inserted
+            for dep in inserted:
+                found[dep[1:]] = dep
+            not_found.difference_update(found)
+            if not_found:
+                # inserted by a concurrent transaction in the meantime
+                deps = self._query_nevras(not_found)
+                self.misses += len(deps)
+                for dep in deps:
+                    found[dep[1:]] = dep
+                self._publish(deps)
+        self._add_found(nevras, found)
+        return [found[nevra] for nevra in nevras]
 
     @stopwatch(total_time, note='dependency cache')
     def get_by_ids(self, ids):
         res = []
         missing = []
+        get_slot = self.ids.get
+        slot_deps = self.slot_deps
+        slot_refs = self.slot_refs
         for dep_id in ids:
-            dep = self.ids.get(dep_id)
-            if dep is None:
+            slot = get_slot(dep_id)
+            if slot is None:
                 missing.append(dep_id)
             else:
-                res.append(dep)
-                self._access(dep)
-        self.misses += len(missing)
+                # inlined _get, this is the hot path
+                slot_refs[slot] = 1
+                res.append(slot_deps[slot])
         self.hits += len(res)
+        if missing and self.nevra_dict:
+            self.nevra_dict.refresh()
+            not_shared = []
+            for dep_id in missing:
+                nevra = self.nevra_dict.get_nevra(dep_id)
+                if nevra is None:
+                    not_shared.append(dep_id)
+                else:
+                    dep = DepTuple(dep_id, *nevra)
+                    self._add(dep)
+                    res.append(dep)
+            self.shared_hits += len(missing) - len(not_shared)
+            missing = not_shared
+        self.misses += len(missing)
         if missing:
-            deps = (
-                self.db.query(*Dependency.inevra)
-                .filter(Dependency.id.in_(missing))
-                .all()
-            )
+            deps = self._query_ids(missing)
             for dep in deps:
                 self._add(dep)
                 res.append(dep)
+            self._publish(deps)
         assert res
         return res
 
@@ -156,7 +366,16 @@ class Resolver(Service):
     def __init__(self, session):
         super(Resolver, self).__init__(session)
         capacity = get_config('dependency.dependency_cache_capacity')
-        self.dependency_cache = DependencyCache(db=self.db, capacity=capacity)
+        capacity_bytes = get_config('dependency.dependency_cache_capacity_bytes')
+        nevra_dict = None
+        if get_config('dependency.shared_nevra_dict'):
+            nevra_dict = NevraDict(
+                os.path.join(get_config('directories.cachedir'), 'dependencies')
+            )
+        self.dependency_cache = DependencyCache(
+            db=self.db, capacity=capacity, capacity_bytes=capacity_bytes,
+            nevra_dict=nevra_dict,
+        )
 
     def get_build_group(self, collection, repo_id):
         """
@@ -197,30 +416,209 @@ class Resolver(Service):
             # TODO packages with no deps
             return []
 
-        cache = self.dependency_cache
+        old = util.set_difference(deps1, deps2, dep_nevra)
+        new = util.set_difference(deps2, deps1, dep_nevra)
+
+        dep_ids = {
+            dep[1:]: dep.id for dep in
+            self.dependency_cache.get_or_create_nevras(
+                [dep_nevra(dep) for dep in old | new]
+            )
+        }
+        return self._pair_dependency_changes(
+            [(dep_ids[dep_nevra(dep)], dep) for dep in old],
+            [(dep_ids[dep_nevra(dep)], dep) for dep in new],
+            rest,
+        )
+
+    def get_dependency_ids(self, deps):
+        """
+        Returns a dict mapping ids of given dependencies (objects with name,
+        epoch, version, release, arch properties) to the dependencies.
+        Dependencies not yet present in the database are inserted.
+        """
+        return {
+            dep.id: orig for dep, orig in zip(
+                self.dependency_cache.get_or_create_nevras(
+                    [dep_nevra(dep) for dep in deps]
+                ),
+                deps,
+            )
+        }
+
+    def find_dependency_ids(self, deps):
+        """
+        Same as get_dependency_ids, but doesn't insert dependencies not yet
+        present in the database. Returns a pair of the dict and a list of
+        such dependencies.
+        """
+        found = self.dependency_cache.get_nevras([dep_nevra(dep) for dep in deps])
+        deps_by_id = {}
+        unknown = []
+        for dep in deps:
+            row = found.get(dep_nevra(dep))
+            if row is None:
+                unknown.append(dep)
+            else:
+                deps_by_id[row.id] = dep
+        return deps_by_id, unknown
+
+    def store_resolution_results(self, collection_id, repo_id, build_group, results):
+        """
+        Stores results of successful resolutions in given repo, so that they
+        can be reused by `get_resolution_result`. Existing entries are kept.
+
+        :param: results list of pairs of (BuildRequires, output of
+                        get_dependency_ids)
+        """
+        if not results:
+            return
+        build_group_hash = fingerprint(build_group)
+        rows = {}
+        for br, deps_by_id in results:
+            requires_hash = fingerprint(br)
+            keys = sorted(deps_by_id)
+            rows[requires_hash] = dict(
+                collection_id=collection_id,
+                repo_id=repo_id,
+                requires_hash=requires_hash,
+                build_group_hash=build_group_hash,
+                dependency_keys=keys,
+                distances=[deps_by_id[key].distance for key in keys],
+            )
+        self.db.execute(
+            pg_insert(ResolutionResult)
+            .values(list(rows.values()))
+            .on_conflict_do_nothing()
+        )
+
+    def copy_resolution_results(self, collection_id, from_repo_id, to_repo_id,
+                                build_group, requires_hashes):
+        """
+        Copies stored results of resolution of BuildRequires with given
+        fingerprints from one repo to another, using a single INSERT ...
+        SELECT. Used for packages whose resolution is known to be the same in
+        both repos. Existing entries are kept.
+        """
+        if not requires_hashes:
+            return
+        query = (
+            self.db.query(
+                ResolutionResult.collection_id,
+                literal(to_repo_id),
+                ResolutionResult.requires_hash,
+                ResolutionResult.build_group_hash,
+                ResolutionResult.dependency_keys,
+                ResolutionResult.distances,
+            )
+            .filter_by(
+                collection_id=collection_id,
+                repo_id=from_repo_id,
+                build_group_hash=fingerprint(build_group),
+            )
+            .filter(ResolutionResult.requires_hash.in_(list(requires_hashes)))
+        )
+        self.db.execute(
+            pg_insert(ResolutionResult)
+            .from_select(
+                [
+                    'collection_id', 'repo_id', 'requires_hash', 'build_group_hash',
+                    'dependency_keys', 'distances',
+                ],
+                query.statement,
+            )
+            .on_conflict_do_nothing()
+        )
+
+    def get_resolution_result(self, collection_id, repo_id, br, build_group):
+        """
+        Looks up a stored result of resolution of given BuildRequires in given
+        repo.
 
-        def key(dep):
-            return dep.name, dep.epoch, dep.version, dep.release, dep.arch
+        :returns: the same as get_dependency_ids for the resolved
+                  dependencies, or None if there's no stored result
+        """
+        result = (
+            self.db.query(ResolutionResult.dependency_keys, ResolutionResult.distances)
+            .filter_by(
+                collection_id=collection_id,
+                repo_id=repo_id,
+                requires_hash=fingerprint(br),
+                build_group_hash=fingerprint(build_group),
+            )
+            .first()
+        )
+        if not result:
+            return None
+        deps = {
+            dep.id: dep for dep in
+            self.dependency_cache.get_by_ids(result.dependency_keys)
+        }
+        deps_by_id = {}
+        for dep_id, distance in zip(result.dependency_keys, result.distances):
+            dep = deps[dep_id]
+            dep_with_distance = depsolve.DependencyWithDistance(
+                name=dep.name, epoch=dep.epoch, version=dep.version,
+                release=dep.release, arch=dep.arch,
+            )
+            dep_with_distance.distance = distance
+            deps_by_id[dep_id] = dep_with_distance
+        return deps_by_id
+
+    @stopwatch(total_time)
+    def create_dependency_changes_from_keys(self, prev_keys, curr_deps_by_id,
+                                            unknown_deps=(), **rest):
+        """
+        Same as create_dependency_changes, but the previous dependencies are
+        given as a sorted list of dependency ids (Build.dependency_keys) and
+        the current ones as output of get_dependency_ids. The difference is
+        computed on sorted id lists and only the previous dependencies that
+        differ are fetched, so when nothing changed, it's just a comparison of
+        two lists.
+
+        :param: unknown_deps current dependencies not present in the database
+                             (as returned by find_dependency_ids). They're all
+                             added dependencies and they're inserted here.
+        """
+        if not prev_keys or not (curr_deps_by_id or unknown_deps):
+            return []
 
-        old = util.set_difference(deps1, deps2, key)
-        new = util.set_difference(deps2, deps1, key)
+        curr_keys = sorted(curr_deps_by_id)
+        if curr_keys == prev_keys and not unknown_deps:
+            return []
+        removed, added = util.sorted_difference(prev_keys, curr_keys)
+        old = self.dependency_cache.get_by_ids(removed) if removed else []
+        new = [(dep_id, curr_deps_by_id[dep_id]) for dep_id in added]
+        if unknown_deps:
+            new += self.get_dependency_ids(unknown_deps).items()
+        return self._pair_dependency_changes(
+            [(dep.id, dep) for dep in old],
+            new,
+            rest,
+        )
 
+    @staticmethod
+    def _pair_dependency_changes(old, new, rest):
+        """
+        Pairs removed and added dependencies (lists of (id, dependency)) by
+        name into dependency changes.
+        """
         changes = {}
-        for dependency in old:
+        for dep_id, dependency in old:
             change = dict(
                 rest,
-                prev_dep_id=cache.get_or_create_nevra(key(dependency)).id,
+                prev_dep_id=dep_id,
                 curr_dep_id=None,
                 distance=None,
             )
             changes[dependency.name] = change
-        for dependency in new:
+        for dep_id, dependency in new:
             change = (
                 changes.get(dependency.name) or
                 dict(rest, distance=None, prev_dep_id=None)
             )
             change.update(
-                curr_dep_id=cache.get_or_create_nevra(key(dependency)).id,
+                curr_dep_id=dep_id,
                 distance=dependency.distance,
             )
             changes[dependency.name] = change
@@ -262,6 +660,41 @@ class Resolver(Service):
             .first()
         )
 
+    def get_prev_builds_for_comparison(self, builds):
+        """
+        Bulk version of `get_prev_build_for_comparison`. Finds preceding
+        builds for multiple builds in a single query, together with their
+        dependency keys.
+
+        :returns: dict mapping build ids to their previous builds. Builds
+                  without a previous build are omitted.
+        """
+        if not builds:
+            return {}
+        prev = aliased(Build)
+        ranked = (
+            self.db.query(
+                Build.id.label('build_id'),
+                prev.id.label('prev_id'),
+                func.row_number().over(
+                    partition_by=Build.id,
+                    order_by=prev.started.desc(),
+                ).label('rank'),
+            )
+            .join(prev, prev.package_id == Build.package_id)
+            .filter(prev.started < Build.started)
+            .filter(prev.deps_resolved == True)
+            .filter(Build.id.in_([build.id for build in builds]))
+            .subquery()
+        )
+        query = (
+            self.db.query(ranked.c.build_id, Build)
+            .join(Build, Build.id == ranked.c.prev_id)
+            .filter(ranked.c.rank == 1)
+            .options(undefer('dependency_keys'))
+        )
+        return {build_id: prev_build for build_id, prev_build in query}
+
     @stopwatch(total_time)
     def get_build_for_comparison(self, package):
         """
@@ -20,9 +20,12 @@
 
 import re
 import os
-import struct
+import sys
+import itertools
 import zlib
 
+from array import array
+
 import sqlalchemy
 
 from sqlalchemy import create_engine, Table, DDL
@@ -200,8 +203,30 @@ def get_or_create(db, table, **cond):
 
 
 class CompressedKeyArray(TypeDecorator):
+    """
+    Sorted list of positive integer keys stored as compressed binary array of
+    deltas between consecutive keys.
+
+    Format versions:
+    1 - zlib-compressed big-endian 32bit deltas. There's no version marker,
+        the value starts directly with zlib header.
+    2 - version byte (0x02, which is never a valid first byte of zlib stream)
+        followed by zlib-compressed 32bit deltas, which are byte-shuffled - all
+        least significant bytes come first, then all second bytes etc. Deltas
+        are mostly small numbers, so the planes of higher bytes are mostly
+        zeros and compress very well. Encoding and decoding of the deltas is
+        done in bulk using arrays.
+
+    New values are always written in the newest format, both formats are
+    readable.
+    """
     impl = BYTEA
 
+    VERSION = 2
+    VERSION_MARKER = bytes([VERSION])
+    # array typecode of 32bit unsigned integer
+    ITEM_TYPE = 'I' if array('I').itemsize == 4 else 'L'
+
     def _compress(self, payload):
         return zlib.compress(payload)
 
@@ -213,28 +238,41 @@ class CompressedKeyArray(TypeDecorator):
         if value is None:
             return None
         value = sorted(value)
-        offset = 0
-        for i in range(len(value)):
-            value[i] -= offset
-            offset += value[i]
-        array = bytearray()
-        for item in value:
-            assert item > 0
-            array += struct.pack(">I", item)
-        return self._compress(array)
+        deltas = array(
+            self.ITEM_TYPE,
+            [item - prev for prev, item in zip(itertools.chain((0,), value), value)],
+        )
+        assert 0 not in deltas
+        if sys.byteorder == 'big':
+            deltas.byteswap()
+        payload = deltas.tobytes()
+        shuffled = b''.join(payload[i::4] for i in range(4))
+        return self.VERSION_MARKER + self._compress(shuffled)
 
     def process_result_value(self, value, _):
         if value is None:
             return None
-        res = []
+        value = bytes(value)
+        if value[:1] != self.VERSION_MARKER:
+            return self._process_result_value_v1(value)
+        shuffled = self._decompress(value[1:])
+        count = len(shuffled) // 4
+        payload = bytearray(len(shuffled))
+        for i in range(4):
+            payload[i::4] = shuffled[i * count:(i + 1) * count]
+        deltas = array(self.ITEM_TYPE)
+        deltas.frombytes(payload)
+        if sys.byteorder == 'big':
+            deltas.byteswap()
+        return list(itertools.accumulate(deltas))
+
+    def _process_result_value_v1(self, value):
         uncompressed = self._decompress(value)
-        for i in range(0, len(uncompressed), 4):
-            res.append(struct.unpack(">I", uncompressed[i:i + 4])[0])
-        offset = 0
-        for i in range(len(res)):
-            res[i] += offset
-            offset = res[i]
-        return res
+        deltas = array(self.ITEM_TYPE)
+        deltas.frombytes(uncompressed)
+        if sys.byteorder == 'little':
+            deltas.byteswap()
+        return list(itertools.accumulate(deltas))
 
 
 def load_ddl():
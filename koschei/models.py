@@ -997,6 +997,28 @@ class RepoMapping(Base):
     task_id = Column(Integer, nullable=False)
 
 
+class ResolutionResult(Base):
+    """
+    Result of a successful resolution of a set of BuildRequires in a repo.
+    Stored by repo_resolver, so that build_resolver doesn't need to resolve
+    builds whose repo and BuildRequires are the same again.
+    Keyed by SHA-256 fingerprints of sorted unique BuildRequires and build
+    group. Entries for repos older than the previous latest repo of the
+    collection are deleted by repo_resolver.
+    """
+    collection_id = Column(
+        ForeignKey(Collection.id, ondelete='CASCADE'),
+        primary_key=True,
+    )
+    repo_id = Column(Integer, primary_key=True)
+    requires_hash = Column(String, primary_key=True)
+    build_group_hash = Column(String, primary_key=True)
+    # sorted ids of the installed dependencies
+    dependency_keys = Column(CompressedKeyArray, nullable=False)
+    # distances of the dependencies, in the order of dependency_keys
+    distances = Column(ARRAY(Integer), nullable=False)
+
+
 class CoprRebuildRequest(Base):
     """
     Used by copr plugin to represent a users request to rebuild packages with additional
@@ -27,11 +27,12 @@ from sqlalchemy.sql import insert
 from copr.v3.exceptions import CoprRequestException
 
 from koschei import util
-from koschei.models import (Package, CoprRebuildRequest, CoprRebuild,
-                            CoprResolutionChange)
+from koschei.models import (Package, Build, Dependency, ResolutionResult,
+                            CoprRebuildRequest, CoprRebuild, CoprResolutionChange)
 from koschei.config import get_config
 from koschei.backend import depsolve, koji_util, repo_util
 from koschei.backend.service import Service
+from koschei.backend.services.resolver import fingerprint
 
 from koschei.plugins.copr_plugin.backend.common import (
     copr_client, RequestProcessingError, prepare_comps, repo_descriptor_for_request,
@@ -47,6 +48,14 @@ class CoprRepoDescriptor(object):
         return self.repo_id
 
 
+def pkg_nevra(pkg):
+    return pkg.name, pkg.epoch, pkg.version, pkg.release, pkg.arch
+
+
+def installed_nevras(installs):
+    return {pkg_nevra(pkg) for pkg in installs if pkg.arch != 'src'}
+
+
 class CoprResolver(Service):
     def set_source_repo_url(self, request):
         owner, name = re.match(r'^copr:([^/]+)/([^/]+)$', request.repo_source).groups()
@@ -71,13 +80,20 @@ class CoprResolver(Service):
             request.yum_repo,
         )
 
-    def add_repo_to_sack(self, request, sack):
+    def get_user_repo(self, request):
+        """
+        Downloads user repo of given request and returns it as hawkey.Repo.
+        """
         desc = self.get_user_repo_descriptor(request)
         repo_dir = os.path.join(get_config('directories.cachedir'), 'user_repos')
         repo = repo_util.get_repo(repo_dir, desc, download=True)
         if not repo:
             raise RequestProcessingError("Cannot download user repo")
+        return repo
+
+    def add_repo_to_sack(self, repo, sack):
         sack.load_repo(repo, load_filelists=True)
+        repo_util.prune_sack(sack, repo.name)
         if get_config('copr.overriding_by_exclusions', True):
             exclusions = []
             pkg_by_name = defaultdict(list)
@@ -96,8 +112,156 @@ class CoprResolver(Service):
                     exclusions += sorted(pkgs, key=cmp_to_key(pkg_cmp))[:-1]
 
             sack.add_excludes(exclusions)
+        sack.clear_caches()
+        # The sack is used only for resolving a slice of packages, building
+        # the whole dependency graph for it would dominate the time spent
+        sack.dependency_graph = depsolve.LazyDependencyGraph(sack)
+
+    def get_stored_resolutions(self, request, packages, brs_list, build_group):
+        """
+        Looks up results of resolution of given packages in the repo of the
+        request, which were already stored by repo resolver or build resolver.
+
+        :returns: dict mapping package ids to pairs of (resolved, set of
+                  installed NEVRAs or None when not resolved)
+        """
+        repo_id = request.repo_id
+        keys_by_package = {}
+        # stored by repo resolver for the BuildRequires in the repo
+        package_ids_by_hash = {}
+        for package, brs in zip(packages, brs_list):
+            package_ids_by_hash.setdefault(fingerprint(brs), []).append(package.id)
+        results = self.db.query(
+            ResolutionResult.requires_hash, ResolutionResult.dependency_keys,
+        ).filter_by(
+            collection_id=request.collection_id,
+            repo_id=repo_id,
+            build_group_hash=fingerprint(build_group),
+        ).filter(ResolutionResult.requires_hash.in_(package_ids_by_hash))
+        for requires_hash, dependency_keys in results:
+            for package_id in package_ids_by_hash[requires_hash]:
+                keys_by_package[package_id] = dependency_keys
+        stored = {}
+        # stored by build resolver if the last build was done in the repo
+        builds = self.db.query(
+            Build.package_id, Build.deps_resolved, Build.dependency_keys,
+        ).filter(
+            Build.id.in_([package.last_complete_build_id for package in packages])
+        ).filter(Build.repo_id == repo_id).filter(Build.deps_resolved != None)
+        for package_id, deps_resolved, dependency_keys in builds:
+            if package_id in keys_by_package:
+                continue
+            if deps_resolved and dependency_keys is not None:
+                keys_by_package[package_id] = dependency_keys
+            elif not deps_resolved:
+                stored[package_id] = (False, None)
+        dep_ids = {dep_id for keys in keys_by_package.values() for dep_id in keys}
+        nevras = {
+            dep_id: tuple(nevra) for dep_id, *nevra in
+            self.db.query(*Dependency.inevra).filter(Dependency.id.in_(dep_ids))
+        } if dep_ids else {}
+        for package_id, dependency_keys in keys_by_package.items():
+            stored[package_id] = (True, {nevras[key] for key in dependency_keys})
+        return stored
+
+    def get_user_repo_deps(self, user_repo):
+        """
+        Returns a pair of sets describing packages from the user repo - names
+        of the packages and of what they provide, obsolete or conflict with
+        (without versions), and everything they provide (including files) as
+        full dependency strings.
+        """
+        user_sack = hawkey.Sack(arch=get_config('dependency.resolve_for_arch'))
+        user_sack.load_repo(user_repo, load_filelists=True)
+        names = set()
+        provides = set()
+        for pkg in hawkey.Query(user_sack):
+            names.add(pkg.name)
+            for dep in pkg.provides:
+                provides.add(str(dep))
+                names.update(depsolve.dep_names(dep))
+            for dep in pkg.obsoletes + pkg.conflicts:
+                names.update(depsolve.dep_names(dep))
+            names.update(pkg.files)
+            provides.update(pkg.files)
+        return names, provides
+
+    def filter_affected(self, sack, user_repo, items):
+        """
+        Filters (package_id, BuildRequires, stored result) triples to those,
+        whose resolution may be affected by adding the user repo to the sack.
+        Packages without a stored successful resolution are always affected.
+        Otherwise a package is affected if any of its BuildRequires references
+        a name from the user repo, or if it installs a package whose name is
+        among them or whose requires match anything the user repo provides.
+
+        The sack is queried in a forked process, because constructing Reldeps
+        adds them to the sack's string pool and the sack is shared with other
+        users of the repo cache.
+        """
+        if not items:
+            return items
+        names, provides = self.get_user_repo_deps(user_repo)
+
+        def query_affected(arg):
+            names, provides = arg
+            query = hawkey.Query(sack)
+            reldeps = [hawkey.Reldep(sack, provide) for provide in provides]
+            return installed_nevras(
+                query.filter(name=list(names)).union(query.filter(requires=reldeps))
+            )
 
-    def resolve_request(self, request, sack_before, sack_after):
+        affected_nevras = (
+            util.run_in_process(query_affected, (names, provides)) if names else set()
+        )
+        return [
+            (package_id, brs, stored) for package_id, brs, stored in items
+            if not stored or not stored[0] or stored[1] & affected_nevras
+            or any(depsolve.dep_names(br) & names for br in brs)
+        ]
+
+    def compare_resolution(self, sack, user_repo, build_group, items):
+        """
+        Resolves given (package_id, BuildRequires, stored result) triples in
+        the base sack, unless they have a stored result of that resolution,
+        then adds the user repo to the sack and resolves them again.
+        The sack is modified, so this is run in forked worker processes,
+        which share the base sack copy-on-write. Doesn't access the database.
+
+        :returns: list of (package_id, resolved before, resolved after,
+                  problems after, priority), where priority is None, unless
+                  the package should be rebuilt because its dependencies
+                  changed
+        """
+        before = []
+        for _, brs, stored in items:
+            if stored is None:
+                resolved, _, installs = depsolve.run_goal(sack, brs, build_group)
+                stored = (resolved, installed_nevras(installs) if resolved else None)
+            before.append(stored)
+        self.add_repo_to_sack(user_repo, sack)
+        results = []
+        for (package_id, brs, _), (resolved1, installs1) in zip(items, before):
+            resolved2, problems2, installs2 = \
+                depsolve.run_goal(sack, brs, build_group)
+            priority = None
+            if resolved1 and resolved2 and \
+                    installs1 != installed_nevras(installs2):
+                changed_deps = [
+                    depsolve.DependencyWithDistance(
+                        name=pkg.name, epoch=pkg.epoch,
+                        version=pkg.version, release=pkg.release,
+                        arch=pkg.arch,
+                    ) for pkg in installs2
+                    if pkg.arch != 'src' and pkg_nevra(pkg) not in installs1
+                ]
+                depsolve.compute_dependency_distances(sack, brs, changed_deps)
+                priority = sum(100 / (d.distance * 2)
+                               for d in changed_deps if d.distance)
+            results.append((package_id, resolved1, resolved2, problems2, priority))
+        return results
+
+    def resolve_request(self, request, sack):
         self.log.info("Processing rebuild request id {}".format(request.id))
 
         # packages with no build have no srpm to fetch buildrequires, so filter them
@@ -122,42 +286,55 @@ class CoprResolver(Service):
             request.collection.build_group,
             request.collection.latest_repo_id,
         )
-        for package, brs in zip(packages, br_gen):
-            resolved1, _, installs1 = \
-                depsolve.run_goal(sack_before, brs, build_group)
-            resolved2, problems2, installs2 = \
-                depsolve.run_goal(sack_after, brs, build_group)
+        user_repo = self.get_user_repo(request)
+        brs_list = list(br_gen)
+        # the "before" side doesn't need to be resolved again if it was
+        # already resolved in the same repo
+        stored = self.get_stored_resolutions(request, packages, brs_list, build_group)
+        self.log.info("Reusing stored resolution of {} of {} packages"
+                      .format(len(stored), len(packages)))
+        items = [
+            (package.id, brs, stored.get(package.id))
+            for package, brs in zip(packages, brs_list)
+        ]
+        if get_config('copr.resolve_only_affected'):
+            # packages unrelated to the user repo stay unchanged
+            items = self.filter_affected(sack, user_repo, items)
+            self.log.info("Resolving {} of {} packages affected by user repo"
+                          .format(len(items), len(packages)))
+        packages_by_id = {package.id: package for package in packages}
+
+        def compare(slice_items):
+            return self.compare_resolution(sack, user_repo, build_group, slice_items)
+
+        # Each worker gets a single slice of packages, because it adds the user
+        # repo to its copy of the sack
+        results = []
+        workers = min(get_config('copr.resolver_workers'), len(items))
+        if workers:
+            slices = [(i, items[i::workers]) for i in range(workers)]
+            gen = util.parallel_process_generator(compare, slices, workers=workers)
+            results = [result for _, slice_results in gen for result in slice_results]
+        for package_id, resolved1, resolved2, problems2, priority in sorted(results):
             if resolved1 != resolved2:
                 change = dict(
                     request_id=request.id,
-                    package_id=package.id,
+                    package_id=package_id,
                     prev_resolved=resolved1,
                     curr_resolved=resolved2,
                     problems=problems2,
                     # TODO compare problems as well?
                 )
                 resolution_changes.append(change)
-            elif resolved2:
-                installs1 = set(installs1)
-                installs2 = set(installs2)
-                if installs1 != installs2:
-                    changed_deps = [
-                        depsolve.DependencyWithDistance(
-                            name=pkg.name, epoch=pkg.epoch,
-                            version=pkg.version, release=pkg.release,
-                            arch=pkg.arch,
-                        ) for pkg in installs2 if pkg not in installs1
-                    ]
-                    depsolve.compute_dependency_distances(sack_after, brs, changed_deps)
-                    priority = sum(100 / (d.distance * 2)
-                                   for d in changed_deps if d.distance)
-                    rebuild = dict(
-                        request_id=request.id,
-                        package_id=package.id,
-                        prev_state=package.last_complete_build_state,
-                        priority=priority,
-                    )
-                    rebuilds.append(rebuild)
+            elif priority is not None:
+                package = packages_by_id[package_id]
+                rebuild = dict(
+                    request_id=request.id,
+                    package_id=package_id,
+                    prev_state=package.last_complete_build_state,
+                    priority=priority,
+                )
+                rebuilds.append(rebuild)
         if rebuilds:
             for i, rebuild in enumerate(sorted(rebuilds, key=lambda x: -x['priority'])):
                 del rebuild['priority']
@@ -183,13 +360,11 @@ class CoprResolver(Service):
                 request.repo_id = collection.latest_repo_id
                 repo_descriptor = repo_descriptor_for_request(request)
                 self.set_source_repo_url(request)
-                with self.session.repo_cache.get_sack(repo_descriptor) as sack_before:
-                    if not sack_before:
+                with self.session.repo_cache.get_sack(repo_descriptor) as sack:
+                    if not sack:
                         raise RuntimeError("Couldn't download koji repo")
-                    sack_after = self.session.repo_cache.get_sack_copy(repo_descriptor)
-                    self.add_repo_to_sack(request, sack_after)
                     prepare_comps(self.session, request, repo_descriptor)
-                    self.resolve_request(request, sack_before, sack_after)
+                    self.resolve_request(request, sack)
                     self.db.commit()
             except RequestProcessingError as e:
                 request.state = 'failed'
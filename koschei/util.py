@@ -25,6 +25,9 @@ import time
 import socket
 import fcntl
 import errno
+import multiprocessing
+import queue
+import traceback
 
 from queue import Queue
 from threading import Thread
@@ -103,6 +106,139 @@ class parallel_generator(object):
         self.stop_thread = True
 
 
+class parallel_process_generator(object):
+    """
+    Process-based variant of parallel_generator. Evaluates given function on
+    items in a pool of forked worker processes and yields (key, result) pairs
+    in the order of completion.
+
+    Workers are forked from the current process, so they share its memory
+    copy-on-write (i.e. an already loaded hawkey.Sack) and the function
+    doesn't need to be picklable. Keys, arguments and results need to be.
+    The function must not use resources that cannot be shared with the parent
+    process, such as the database connection.
+
+    :fn: function taking a single argument
+    :items: iterable of (key, argument) pairs, consumed by a separate thread
+    :workers: number of worker processes
+    :queue_size: maximum number of pending items in each direction
+    """
+    poll_interval = 5
+
+    def __init__(self, fn, items, workers, queue_size=1000):
+        ctx = multiprocessing.get_context('fork')
+        self.fn = fn
+        self.task_queue = ctx.Queue(maxsize=queue_size)
+        self.result_queue = ctx.Queue(maxsize=queue_size)
+        self.feeder_exception = None
+        self.stop_feeder = False
+        self.workers_done = 0
+        # fork before starting any thread of our own
+        self.processes = [ctx.Process(target=self.worker_fn, daemon=True)
+                          for _ in range(workers)]
+        for process in self.processes:
+            process.start()
+        self.feeder = Thread(target=self.feeder_fn, args=(items,))
+        self.feeder.daemon = True
+        self.feeder.start()
+
+    def put_task(self, item):
+        """
+        Puts item into the task queue, unless the generator is stopped while
+        waiting for a free slot. Returns whether the item was put.
+        """
+        while not self.stop_feeder:
+            try:
+                self.task_queue.put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def feeder_fn(self, items):
+        try:
+            for item in items:
+                if not self.put_task(item):
+                    return
+        except Exception as e:
+            self.feeder_exception = e
+        finally:
+            for _ in self.processes:
+                if not self.put_task(None):
+                    break
+            if self.stop_feeder:
+                # nobody reads the tasks anymore
+                self.task_queue.cancel_join_thread()
+                self.task_queue.close()
+
+    def worker_fn(self):
+        try:
+            while True:
+                item = self.task_queue.get()
+                if item is None:
+                    break
+                key, arg = item
+                self.result_queue.put(('result', (key, self.fn(arg))))
+        except Exception:
+            self.result_queue.put(('error', traceback.format_exc()))
+        finally:
+            self.result_queue.put(('done', None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            try:
+                kind, payload = self.result_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if any(p.exitcode not in (None, 0) for p in self.processes):
+                    self.stop()
+                    raise RuntimeError("Worker process terminated unexpectedly")
+                continue
+            if kind == 'result':
+                return payload
+            if kind == 'error':
+                self.stop()
+                raise RuntimeError("Worker process failed:\n" + payload)
+            self.workers_done += 1
+            if self.workers_done == len(self.processes):
+                for process in self.processes:
+                    process.join()
+                if self.feeder_exception:
+                    raise self.feeder_exception
+                raise StopIteration
+
+    def stop(self):
+        """
+        Terminates the workers. The feeder thread finishes when it gets to
+        the next item or within poll_interval if it's waiting for a free slot
+        in the task queue.
+        """
+        self.stop_feeder = True
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join()
+        self.result_queue.cancel_join_thread()
+        self.result_queue.close()
+
+
+def run_in_process(fn, arg):
+    """
+    Evaluates given function in a forked process and returns its result, so
+    that the memory it allocates is released when it returns. Falls back to
+    evaluating it in the current process when it's a daemonic process, which
+    is not allowed to have children. The same restrictions as for
+    parallel_process_generator apply.
+    """
+    if multiprocessing.current_process().daemon:
+        return fn(arg)
+    [(_, result)] = list(parallel_process_generator(fn, [(None, arg)], workers=1))
+    return result
+
+
 def set_difference(s1, s2, key):
     compset = {key(x) for x in s2}
     return {x for x in s1 if key(x) not in compset}
@@ -126,6 +262,38 @@ def merge_sorted(iterable1, iterable2, key):
         heads[index] = next(iters[index], None)
 
 
+def sorted_difference(iterable1, iterable2):
+    """
+    Merges two sorted iterables of unique items. Returns a pair of lists -
+    items only present in the first one and items only present in the second
+    one.
+    """
+    only1 = []
+    only2 = []
+    iter1 = iter(iterable1)
+    iter2 = iter(iterable2)
+    sentinel = object()
+    head1 = next(iter1, sentinel)
+    head2 = next(iter2, sentinel)
+    while head1 is not sentinel and head2 is not sentinel:
+        if head1 == head2:
+            head1 = next(iter1, sentinel)
+            head2 = next(iter2, sentinel)
+        elif head1 < head2:
+            only1.append(head1)
+            head1 = next(iter1, sentinel)
+        else:
+            only2.append(head2)
+            head2 = next(iter2, sentinel)
+    if head1 is not sentinel:
+        only1.append(head1)
+        only1.extend(iter1)
+    if head2 is not sentinel:
+        only2.append(head2)
+        only2.extend(iter2)
+    return only1, only2
+
+
 class FileLock(object):
     """
     File lock object using fcntl locking.
@@ -17,11 +17,15 @@
 # Author: Michael Simacek <msimacek@redhat.com>
 
 import shlex
+import struct
+import zlib
 
 from datetime import datetime
 from tempfile import NamedTemporaryFile
 from mock import patch
 
+from sqlalchemy import func, update, literal
+from sqlalchemy.dialects.postgresql import BYTEA
 from sqlalchemy.exc import InvalidRequestError
 
 from test.common import DBTest, KoscheiMockSessionMixin, with_koji_cassette
@@ -65,6 +69,21 @@ class AdminTest(DBTest):
         self.assertIs(None, b1)
         self.assertIsNot(None, b2)
 
+    def test_reencode_dependency_keys(self):
+        build = self.prepare_build('rnv', state=True)
+        v1 = zlib.compress(struct.pack('>3I', 2, 1, 4))
+        self.db.execute(
+            update(Build).where(Build.id == build.id)
+            .values(dependency_keys=literal(v1, BYTEA))
+        )
+        self.call_command('reencode-dependency-keys')
+        stored = self.db.query(func.get_byte(Build.dependency_keys, 0))\
+            .filter(Build.id == build.id)\
+            .scalar()
+        self.assertEqual(2, stored)
+        self.db.expire_all()
+        self.assertEqual([2, 3, 7], self.db.query(Build).get(build.id).dependency_keys)
+
     def test_add_pkg(self):
         rnv = self.prepare_package('rnv', tracked=False)
         eclipse = self.prepare_package('eclipse', tracked=False)
@@ -22,9 +22,14 @@ import koji
 
 from mock import patch
 
-from test.common import testdir, DBTest, service_ctor, my_vcr
-from koschei.models import Build, CoprRebuildRequest
+from test.common import (
+    testdir, DBTest, RepoCacheMock, service_ctor, my_vcr, with_config,
+)
+from koschei import util
+from koschei.models import Build, CoprRebuildRequest, Dependency, ResolutionResult
+from koschei.backend.koji_util import KojiRepoDescriptor
 from koschei.backend.repo_util import get_repo
+from koschei.backend.services.resolver import fingerprint
 
 
 CoprResolver = service_ctor('copr_resolver', 'copr')
@@ -33,14 +38,18 @@ REPO_URL = 'https://download.copr-dev.fedorainfracloud.org/results/mizdebsk/'\
     'isync-gmail/fedora-rawhide-x86_64/'
 
 
+def get_user_repo(name):
+    repo = hawkey.Repo(name)
+    path = os.path.join(testdir, 'repos', 'copr_repo', 'repodata')
+    repo.repomd_fn = os.path.join(path, 'repomd.xml')
+    repo.primary_fn = os.path.join(path, 'primary.xml')
+    repo.filelists_fn = os.path.join(path, 'filelists.xml')
+    return repo
+
+
 def get_repo_mock(repo_dir, descriptor, download=False):
     if 'copr' in str(type(descriptor)).lower():
-        repo = hawkey.Repo(str(descriptor))
-        path = os.path.join(testdir, 'repos', 'copr_repo', 'repodata')
-        repo.repomd_fn = os.path.join(path, 'repomd.xml')
-        repo.primary_fn = os.path.join(path, 'primary.xml')
-        repo.filelists_fn = os.path.join(path, 'filelists.xml')
-        return repo
+        return get_user_repo(str(descriptor))
     return get_repo(repo_dir, descriptor, download)
 
 
@@ -89,3 +98,115 @@ class CoprResolverTest(DBTest):
              for c in self.request.resolution_changes]
         )
         self.assertEqual(2, len(self.request.rebuilds))
+
+    @with_config('copr.resolver_workers', 1)
+    def test_resolver_single_worker(self):
+        self.test_resolver()
+
+    def prepare_installs(self):
+        """
+        Dependencies installed for copr-test1 after adding the user repo
+        """
+        deps = [
+            Dependency(name='copr-test1', epoch=0, version='3.3', release='3.fc22',
+                       arch='x86_64'),
+            Dependency(name='R', epoch=0, version='3.3', release='2.fc22',
+                       arch='x86_64'),
+        ]
+        self.db.add_all(deps)
+        self.db.flush()
+        return sorted(dep.id for dep in deps)
+
+    def run_resolver(self, brs_list):
+        with patch('koschei.backend.repo_util.get_repo', side_effect=get_repo_mock), \
+                patch('koschei.backend.koji_util.get_rpm_requires_cached',
+                      return_value=brs_list), \
+                patch('koschei.backend.koji_util.get_build_group_cached',
+                      return_value=['R']), \
+                my_vcr.use_cassette('copr_resolver1'):
+            self.resolver.main()
+        self.assertEqual(123, self.request.repo_id)
+        return (
+            [(c.package.name, c.prev_resolved, c.curr_resolved)
+             for c in self.request.resolution_changes],
+            [r.package.name for r in self.request.rebuilds],
+        )
+
+    def test_resolver_reuses_resolution_result(self):
+        self.prepare_build('c1', True, repo_id=122)
+        self.db.add(ResolutionResult(
+            collection_id=self.collection.id, repo_id=123,
+            requires_hash=fingerprint(['copr-test1']),
+            build_group_hash=fingerprint(['R']),
+            dependency_keys=self.prepare_installs(), distances=[1, None],
+        ))
+        self.db.commit()
+        # resolved again, there would be a rebuild, because copr-test1 was
+        # updated
+        self.assertEqual(([], []), self.run_resolver([['copr-test1']]))
+
+    def test_resolver_reuses_build_dependency_keys(self):
+        build = self.prepare_build('c1', True, repo_id=123)
+        build.dependency_keys = self.prepare_installs()
+        self.db.commit()
+        self.assertEqual(([], []), self.run_resolver([['copr-test1']]))
+
+    def test_resolver_reuses_unresolved_build(self):
+        self.prepare_build('c1', True, repo_id=123, resolved=False)
+        # different repo, cannot be reused
+        self.prepare_build('c2', True, repo_id=122, resolved=False)
+        self.assertEqual(
+            ([('c1', False, True)], ['c2']),
+            self.run_resolver([['copr-test1'], ['copr-test1']]),
+        )
+
+    def test_resolver_no_packages(self):
+        with patch('koschei.util.parallel_process_generator') as fork:
+            self.assertEqual(([], []), self.run_resolver([]))
+        fork.assert_not_called()
+        self.assertEqual('finished', self.request.state)
+
+    @with_config('copr.resolver_workers', 4)
+    def test_resolver_workers_capped(self):
+        self.prepare_build('c1', True, repo_id=122)
+        self.db.commit()
+        with patch('koschei.util.parallel_process_generator',
+                   wraps=util.parallel_process_generator) as fork:
+            self.run_resolver([['copr-test1']])
+        self.assertEqual(1, fork.call_args[1]['workers'])
+
+    def test_filter_affected(self):
+        desc = KojiRepoDescriptor(koji_id='primary', repo_id=123, build_tag='f25-build')
+        with RepoCacheMock().get_sack(desc) as sack:
+            installs = {
+                name: (name, 0, '1', '1.fc22', 'x86_64') for name in 'ABCDR'
+            }
+            items = [
+                # unrelated
+                (1, ['A'], (True, {installs[n] for n in 'ABCR'})),
+                # unrelated, unresolved
+                (2, ['D'], (False, None)),
+                # not resolved yet
+                (3, ['C'], None),
+                # requires a provide from the user repo
+                (4, ['provide-that-will-be-added >= 1'], (True, {installs['R']})),
+                # installs a package that is in the user repo
+                (5, ['A'], (True, {('copr-test1', 0, '3.3', '2.fc22', 'x86_64')})),
+                # requires a pkgconfig provide from the user repo
+                (6, ['pkgconfig(copr-test) >= 3'], (True, {installs['R']})),
+                # requires a soname provided by the user repo
+                (7, ['libcopr-test.so.1()(64bit)'], (True, {installs['R']})),
+                # requires an unrelated pkgconfig provide
+                (8, ['pkgconfig(glib-2.0)'], (True, {installs['R']})),
+            ]
+            with patch('koschei.util.run_in_process',
+                       wraps=util.run_in_process) as run_in_process:
+                affected = self.resolver.filter_affected(
+                    sack, get_user_repo('copr'), items,
+                )
+        self.assertEqual(
+            [2, 3, 4, 5, 6, 7],
+            [package_id for package_id, _, _ in affected],
+        )
+        # the shared sack is queried in a forked process
+        run_in_process.assert_called_once()
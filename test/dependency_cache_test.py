@@ -17,7 +17,13 @@
 # Author: Michael Simacek <msimacek@redhat.com>
 # Author: Mikolaj Izdebski <mizdebsk@redhat.com>
 
+import shutil
+import tempfile
+
+from mock import patch
+
 from test.common import DBTest
+from koschei.backend.nevra_dict import NevraDict
 from koschei.backend.services.resolver import DependencyCache
 from koschei.models import Dependency
 
@@ -103,6 +109,51 @@ class DependencyCacheTest(DBTest):
         hash(dep2)
         hash(dep3)
 
+    def test_get_nevras_duplicates(self):
+        cache = DependencyCache(self.db, 10)
+        deps = cache.get_or_create_nevras(
+            [self.nevra(4), self.nevra(2), self.nevra(4), self.nevra(2)]
+        )
+        self.assertEqual(
+            [self.dep(4), self.dep(2), self.dep(4), self.dep(2)],
+            deps,
+        )
+        self.assertEqual(1, cache.inserts)
+        self.assertEqual(1, self.db.query(Dependency).filter_by(version='4').count())
+
+    def test_get_nevras_null_epoch(self):
+        nevra = ('foo', None, '5', '1', 'x86_64')
+        dep1 = DependencyCache(self.db, 10).get_or_create_nevra(nevra)
+        # a fresh cache has to find it in the database
+        cache = DependencyCache(self.db, 10)
+        dep2, dep3 = cache.get_or_create_nevras([nevra, self.nevra(2)])
+        self.assertEqual(dep1, dep2)
+        self.assertEqual(nevra, dep2[1:])
+        self.assertEqual(self.dep(2), dep3)
+        self.assertEqual(0, cache.inserts)
+        self.assertEqual(1, self.db.query(Dependency).filter_by(version='5').count())
+
+    def test_get_nevras_without_insert(self):
+        cache = DependencyCache(self.db, 10)
+        found = cache.get_nevras([self.nevra(2), self.nevra(4)])
+        self.assertEqual({self.nevra(2): self.dep(2)}, found)
+        self.assertEqual(0, cache.inserts)
+        self.assertEqual(0, self.db.query(Dependency).filter_by(version='4').count())
+        # from cache
+        cache.db = None
+        self.assertEqual({self.nevra(2): self.dep(2)}, cache.get_nevras([self.nevra(2)]))
+
+    def test_get_nevras_inserted_concurrently(self):
+        cache = DependencyCache(self.db, 10)
+        query_nevras = cache._query_nevras
+        # first lookup misses a row that gets inserted concurrently
+        with patch.object(cache, '_query_nevras',
+                          side_effect=[[], query_nevras([self.nevra(2)])]):
+            dep = cache.get_or_create_nevra(self.nevra(2))
+        self.assertEqual(self.dep(2), dep)
+        self.assertEqual(0, cache.inserts)
+        self.assertEqual(1, self.db.query(Dependency).filter_by(version='2').count())
+
     def test_lru(self):
         cache = DependencyCache(self.db, 2)
         # from db
@@ -150,3 +201,101 @@ class DependencyCacheTest(DBTest):
         dep3 = cache.get_or_create_nevras([self.nevra(3)])[0]
         self.assertEqual(self.dep(3), dep3)
         hash(dep3)
+
+    def test_capacity_bytes(self):
+        cache = DependencyCache(self.db, 10, capacity_bytes=2 * 400)
+        cache.get_by_ids([1, 2, 3])
+        self.assertEqual(2, len(cache.ids))
+        self.assertLessEqual(cache.size, 2 * 400)
+        # the least recently used one was evicted
+        cache.db = None
+        cache.get_by_ids([2, 3])
+
+    def test_shared_nevra_dict(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache = DependencyCache(self.db, 10, nevra_dict=NevraDict(tmpdir))
+        dep1, dep4 = cache.get_or_create_nevras([self.nevra(1), self.nevra(4)])
+        self.assertEqual(1, cache.inserts)
+        # inserted rows are shared only after commit
+        nevra_dict = NevraDict(tmpdir)
+        nevra_dict.refresh()
+        self.assertEqual(self.nevra(1), nevra_dict.get_nevra(dep1.id))
+        self.assertIsNone(nevra_dict.get_nevra(dep4.id))
+        self.db.commit()
+        other = DependencyCache(self.db, 10, nevra_dict=NevraDict(tmpdir))
+        other.db = None
+        self.assertEqual([self.dep(1), self.dep(4)],
+                         other.get_or_create_nevras([self.nevra(1), self.nevra(4)]))
+        self.assertCountEqual([self.dep(1), self.dep(4)],
+                              other.get_by_ids([dep1.id, dep4.id]))
+        self.assertEqual(4, other.shared_hits)
+
+    def test_shared_nevra_dict_rollback(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache = DependencyCache(self.db, 10, nevra_dict=NevraDict(tmpdir))
+        dep = cache.get_or_create_nevra(self.nevra(5))
+        self.db.rollback()
+        self.db.commit()
+        nevra_dict = NevraDict(tmpdir)
+        nevra_dict.refresh()
+        self.assertIsNone(nevra_dict.get_id(self.nevra(5)))
+        self.assertIsNone(nevra_dict.get_nevra(dep.id))
+        self.assertNotIn(self.nevra(5), cache.nevras)
+
+    def test_shared_nevra_dict_validation(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        NevraDict(tmpdir).add([(1, 'bar', 0, '1', '1', 'noarch')])
+        nevra_dict = NevraDict(tmpdir)
+        DependencyCache(self.db, 10, nevra_dict=nevra_dict)
+        self.assertIsNone(nevra_dict.get_nevra(1))
+
+    def test_duplicate_ids(self):
+        cache = DependencyCache(self.db, 2)
+        cache.get_by_ids([2, 2])
+        self.assertEqual(1, len(cache.ids))
+        # eviction doesn't find stale slots
+        cache.get_by_ids([1, 3])
+        cache.get_by_ids([2])
+        self.assertEqual(len(cache.ids), len(cache.nevras))
+
+    def test_duplicate_ids_shared(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        NevraDict(tmpdir).add([self.dep(1), self.dep(2), self.dep(3)])
+        cache = DependencyCache(self.db, 2, nevra_dict=NevraDict(tmpdir))
+        cache.db = None
+        self.assertEqual([self.dep(2), self.dep(2)], cache.get_by_ids([2, 2]))
+        self.assertEqual(2, cache.shared_hits)
+        cache.get_by_ids([1, 3])
+        cache.get_by_ids([2])
+        self.assertEqual(len(cache.ids), len(cache.nevras))
+
+    def test_nevra_dict_sparse_ids(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        nevra_dict = NevraDict(tmpdir)
+        deps = [(i * 100003, 'dep{}'.format(i), None, '1', '1', 'noarch')
+                for i in range(1, 1000)]
+        nevra_dict.add(deps)
+        # index size doesn't depend on the values of ids
+        self.assertLessEqual(len(nevra_dict.slots_by_id), 4096)
+        for dep in deps:
+            self.assertEqual(dep[1:], nevra_dict.get_nevra(dep[0]))
+            self.assertEqual(dep[0], nevra_dict.get_id(dep[1:]))
+        self.assertIsNone(nevra_dict.get_nevra(100004))
+
+    def test_nevra_dict_validation_sample(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        nevra_dict = NevraDict(tmpdir)
+        nevra_dict.add([(i, 'dep{}'.format(i), None, '1', '1', 'noarch')
+                        for i in range(1, 11)])
+        # only a record in the middle doesn't match
+        rows = [(i, 'dep{}'.format(i), None, '1', '1', 'noarch')
+                for i in range(1, 11) if i != 5]
+        rows.append((5, 'other', None, '1', '1', 'noarch'))
+        nevra_dict.validate(lambda ids: [row for row in rows if row[0] in ids])
+        self.assertIsNone(nevra_dict.get_nevra(1))
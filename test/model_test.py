@@ -16,10 +16,16 @@
 #
 # Author: Mikolaj Izdebski <mizdebsk@redhat.com>
 
+import struct
+import zlib
+
+from unittest import TestCase
 from mock import patch
 from sqlalchemy import literal_column
 from datetime import datetime, timedelta
 
+from koschei.db import CompressedKeyArray
+
 from koschei.models import (
     Package, Collection, Build, ResourceConsumptionStats, ScalarStats, KojiTask,
     PackageGroup,
@@ -67,6 +73,27 @@ class BuildURLTest(DBTest):
         self.assertEqual(self.SEC_RESULT_URL, task.results_url)
 
 
+class CompressedKeyArrayTest(TestCase):
+    def roundtrip(self, value):
+        column_type = CompressedKeyArray()
+        encoded = column_type.process_bind_param(value, None)
+        self.assertEqual(b'\x02', encoded[:1])
+        return column_type.process_result_value(encoded, None)
+
+    def test_roundtrip(self):
+        self.assertEqual([1, 2, 300, 70000, 2 ** 32 - 1],
+                         self.roundtrip([70000, 2, 1, 2 ** 32 - 1, 300]))
+        self.assertEqual([], self.roundtrip([]))
+        self.assertIsNone(CompressedKeyArray().process_bind_param(None, None))
+
+    def test_decode_v1(self):
+        v1 = zlib.compress(struct.pack('>4I', 1, 1, 298, 69700))
+        self.assertEqual([1, 2, 300, 70000],
+                         CompressedKeyArray().process_result_value(v1, None))
+        self.assertEqual([],
+                         CompressedKeyArray().process_result_value(zlib.compress(b''), None))
+
+
 class GroupTest(DBTest):
     def test_group_name_format(self):
         group1 = self.prepare_group('foo', content=['foo'])
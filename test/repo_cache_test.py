@@ -20,11 +20,12 @@ import contextlib
 import os
 import json
 import collections
+import multiprocessing
 
 from mock import patch, Mock
 
-from test.common import DBTest
-from koschei.backend import repo_cache
+from test.common import DBTest, with_config
+from koschei.backend import file_cache, repo_cache, repo_util
 from koschei.backend.koji_util import KojiRepoDescriptor
 
 
@@ -50,7 +51,10 @@ class RepoCacheTest(DBTest):
         with open('repodata/index.json', 'w') as index:
             json.dump(dict(
                 version=repo_cache.RepoCache.INDEX_VERSION,
-                entries={str(d): 'ready' for d in self.descriptors.values()},
+                entries={
+                    str(d): dict(state='ready', atime=i, size=1000)
+                    for i, d in enumerate(self.descriptors.values())
+                },
             ), index)
 
     def test_read_from_disk(self):
@@ -70,6 +74,7 @@ class RepoCacheTest(DBTest):
             load_sack.assert_called_once_with('./repodata', desc, download=True)
             self.assertIs(load_sack(), sack)
 
+    @with_config('dependency.cache_l1_capacity', 0)
     def test_reuse(self):
         desc = KojiRepoDescriptor('primary', 'build_tag', 1)
         with patch('koschei.backend.repo_util.load_sack') as load_sack:
@@ -84,6 +89,7 @@ class RepoCacheTest(DBTest):
             load_sack.assert_called_once_with('./repodata', desc)
             self.assertIs(load_sack(), sack)
 
+    @with_config('dependency.cache_l1_capacity', 0)
     def test_reuse_existing(self):
         desc = KojiRepoDescriptor('primary', 'build_tag', 1)
         with patch('koschei.backend.repo_util.load_sack') as load_sack:
@@ -100,3 +106,174 @@ class RepoCacheTest(DBTest):
                 pass
             load_sack.assert_called_once_with('./repodata', desc)
             self.assertIs(load_sack(), sack)
+
+    @with_config('dependency.cache_l1_capacity', 1)
+    def test_resident(self):
+        with patch('koschei.backend.repo_util.load_sack') as load_sack:
+            cache = repo_cache.RepoCache()
+            with cache.get_sack(self.descriptors[666]) as sack1:
+                pass
+            with cache.get_sack(self.descriptors[666]) as sack2:
+                pass
+            load_sack.assert_called_once_with('./repodata', self.descriptors[666])
+            self.assertIs(sack1, sack2)
+            load_sack.reset_mock()
+
+            # evicts the first one
+            with cache.get_sack(self.descriptors[123]):
+                pass
+            self.assertEqual([self.descriptors[123]], list(cache.resident))
+            with cache.get_sack(self.descriptors[666]):
+                pass
+            self.assertEqual(2, load_sack.call_count)
+            cache.clear_resident()
+            self.assertEqual([], list(cache.resident))
+
+    @with_config('dependency.cache_l1_capacity', 1)
+    def test_resident_shared_with_other_process(self):
+        desc = self.descriptors[666]
+
+        def get_item_in_other_process():
+            with repo_cache.RepoCache().get_item(desc) as sack:
+                assert sack
+
+        with patch('koschei.backend.repo_util.load_sack'):
+            cache = repo_cache.RepoCache()
+            with cache.get_sack(desc):
+                pass
+            self.assertEqual([desc], list(cache.resident))
+            process = multiprocessing.get_context('fork')\
+                .Process(target=get_item_in_other_process)
+            process.start()
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+                self.fail("Other process blocked on a resident repo")
+            self.assertEqual(0, process.exitcode)
+            # hits of resident sack are recorded in the index as well
+            atime = self.read_index()[str(desc)]['atime']
+            with cache.get_sack(desc):
+                pass
+            self.assertGreater(self.read_index()[str(desc)]['atime'], atime)
+
+    def test_prefetch(self):
+        with patch('koschei.backend.repo_util.load_sack') as load_sack:
+            cache = repo_cache.RepoCache()
+            self.assertTrue(cache.prefetch(self.descriptors[666]))
+            load_sack.assert_not_called()
+            desc = KojiRepoDescriptor('primary', 'build_tag', 1)
+            self.assertTrue(cache.prefetch(desc))
+            load_sack.assert_called_once_with('./repodata', desc, download=True)
+
+    def read_index(self):
+        with open('repodata/index.json') as index:
+            return json.load(index)['entries']
+
+    @with_config('dependency.cache_l1_capacity', 0)
+    @with_config('dependency.cache_l2_capacity', 4)
+    def test_lru_eviction(self):
+        with patch('koschei.backend.repo_util.load_sack'):
+            cache = repo_cache.RepoCache()
+            # the least recently used one becomes the most recently used
+            with cache.get_sack(self.descriptors[7]):
+                pass
+            with cache.get_sack(KojiRepoDescriptor('primary', 'build_tag', 1)):
+                pass
+        entries = self.read_index()
+        self.assertNotIn(str(self.descriptors[123]), entries)
+        self.assertIn(str(self.descriptors[7]), entries)
+        self.assertFalse(os.path.exists(os.path.join('repodata',
+                                                     str(self.descriptors[123]))))
+        self.assertEqual((1, 1, 1), (cache.hits, cache.misses, cache.evictions))
+
+    @with_config('dependency.cache_l2_capacity_bytes', 2500)
+    def test_byte_budget_eviction(self):
+        with patch('koschei.backend.repo_util.load_sack'):
+            cache = repo_cache.RepoCache()
+            with cache.get_sack(KojiRepoDescriptor('primary', 'build_tag', 1)):
+                pass
+        entries = self.read_index()
+        self.assertEqual(
+            {str(self.descriptors[666]), str(self.descriptors[1024]),
+             str(KojiRepoDescriptor('primary', 'build_tag', 1))},
+            set(entries),
+        )
+
+    @with_config('dependency.cache_l1_capacity', 2)
+    @with_config('dependency.cache_l2_capacity_bytes', 500)
+    def test_byte_budget_exhausted(self):
+        with patch('koschei.backend.repo_util.load_sack'):
+            cache = repo_cache.RepoCache()
+            # resident sacks cannot be evicted
+            for repo_id in (666, 1024):
+                with cache.get_sack(self.descriptors[repo_id]):
+                    pass
+            with self.assertRaises(file_cache.CacheExhaustedException):
+                with cache.get_sack(KojiRepoDescriptor('primary', 'build_tag', 1)):
+                    pass
+
+    def test_index_v1_migration(self):
+        with open('repodata/index.json', 'w') as index:
+            json.dump(dict(
+                version=1,
+                entries={str(d): 'ready' for d in self.descriptors.values()},
+            ), index)
+        with patch('koschei.backend.repo_util.load_sack') as load_sack:
+            cache = repo_cache.RepoCache()
+            with patch.object(cache, '_disk_usage', return_value=1000) as disk_usage:
+                with cache.get_sack(self.descriptors[666]):
+                    pass
+                with cache.get_sack(self.descriptors[123]):
+                    pass
+            load_sack.assert_called_with('./repodata', self.descriptors[123])
+        # migrated only once
+        self.assertEqual(4, disk_usage.call_count)
+        with open('repodata/index.json') as index:
+            self.assertEqual(2, json.load(index)['version'])
+        entries = self.read_index()
+        self.assertEqual(4, len(entries))
+        self.assertEqual('ready', entries[str(self.descriptors[666])]['state'])
+
+
+class RepodataObjectsTest(DBTest):
+    def prepare_repo(self, name, content):
+        os.makedirs(os.path.join(name, 'repodata'), exist_ok=True)
+        with open(os.path.join(name, 'repodata', 'filelists.xml.gz'), 'w') as f:
+            f.write(content)
+
+    def test_objects(self):
+        record = {
+            'checksum_type': 'sha256',
+            'checksum': 'abcd',
+            'location_href': 'repodata/filelists.xml.gz',
+        }
+        self.assertFalse(repo_util.link_object('objects', record, 'repo1'))
+        self.prepare_repo('repo1', 'filelists')
+        repo_util.store_object('objects', record, 'repo1')
+        self.assertTrue(repo_util.link_object('objects', record, 'repo2'))
+        with open('repo2/repodata/filelists.xml.gz') as f:
+            self.assertEqual('filelists', f.read())
+        self.assertEqual(3, os.stat('objects/sha256/abcd').st_nlink)
+
+        repo_util.remove_unreferenced_objects('objects')
+        self.assertTrue(os.path.exists('objects/sha256/abcd'))
+        os.unlink('repo1/repodata/filelists.xml.gz')
+        os.unlink('repo2/repodata/filelists.xml.gz')
+        repo_util.remove_unreferenced_objects('objects')
+        self.assertFalse(os.path.exists('objects/sha256/abcd'))
+
+    def test_disk_usage_with_objects(self):
+        record = {
+            'checksum_type': 'sha256',
+            'checksum': 'abcd',
+            'location_href': 'repodata/filelists.xml.gz',
+        }
+        self.prepare_repo('cache/repo1', 'x' * 10000)
+        repo_util.store_object('objects', record, 'cache/repo1')
+        size = os.stat('objects/sha256/abcd').st_blocks * 512
+        cache = file_cache.FileCache('cache', 10, external_links=1)
+        # the object directory link is counted against the repo
+        self.assertEqual(size, cache._disk_usage('repo1'))
+        repo_util.link_object('objects', record, 'cache/repo2')
+        self.assertEqual(size // 2, cache._disk_usage('repo1'))
+        self.assertEqual(size // 2, cache._disk_usage('repo2'))
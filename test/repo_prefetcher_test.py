@@ -0,0 +1,55 @@
+# Copyright (C) 2014-2020  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from mock import patch
+
+from test.common import DBTest, with_config
+from koschei.backend import koji_util
+from koschei.backend.services.repo_prefetcher import RepoPrefetcher
+
+
+def descriptor(koji_session, repo_id):
+    return koji_util.KojiRepoDescriptor('primary', 'f25-build', repo_id)
+
+
+class RepoPrefetcherTest(DBTest):
+    def setUp(self):
+        super(RepoPrefetcherTest, self).setUp()
+        self.prefetcher = RepoPrefetcher(self.session)
+
+    def prefetch(self, latest_repo_id):
+        with patch('koschei.backend.koji_util.get_latest_repo',
+                   return_value={'id': latest_repo_id}), \
+            patch('koschei.backend.koji_util.create_repo_descriptor',
+                  side_effect=descriptor), \
+            patch.object(self.session.repo_cache, 'prefetch',
+                         create=True, return_value=True) as prefetch:
+            self.prefetcher.main()
+        return [c[0][0].repo_id for c in prefetch.call_args_list]
+
+    def test_new_repo(self):
+        self.assertEqual([124], self.prefetch(124))
+
+    def test_resolved_repo(self):
+        self.assertEqual([], self.prefetch(123))
+
+    @with_config('dependency.prefetch_build_repos', 2)
+    def test_build_repos(self):
+        for repo_id in (120, 121, 122):
+            self.prepare_build('foo', True, repo_id=repo_id, resolved=None)
+        self.prepare_build('bar', True, repo_id=119, resolved=True)
+        self.assertEqual([122, 121], self.prefetch(123))
@@ -23,18 +23,21 @@ import hawkey
 import koji
 from contextlib import contextmanager
 from mock import Mock, patch
+from sqlalchemy import inspect
 from koschei_messages.collection import CollectionStateChange
 from koschei_messages.package import PackageStateChange
 
-from test.common import DBTest, RepoCacheMock, rpmvercmp
-from koschei import plugin
+from test.common import (
+    DBTest, RepoCacheMock, rpmvercmp, with_config, patch_config,
+)
+from koschei import plugin, util
 from koschei.db import RpmEVR
-from koschei.backend import koji_util
-from koschei.backend.services.repo_resolver import RepoResolver
+from koschei.backend import depsolve, koji_util, repo_util
+from koschei.backend.services.repo_resolver import RepoResolver, IncrementalState
 from koschei.backend.services.build_resolver import BuildResolver
 from koschei.models import (
     Dependency, UnappliedChange, Package, ResolutionProblem,
-    BuildrootProblem, ResolutionChange, Build,
+    BuildrootProblem, ResolutionChange, Build, ResolutionResult,
 )
 
 MINIMAL_HAWKEY_VERSION = '0.6.2'
@@ -151,6 +154,90 @@ class ResolverTest(DBTest):
 
         self.assertIsNone(old_build.dependency_keys)
 
+    def test_process_builds_of_same_package(self):
+        old_build = self.prepare_old_build()
+        build1 = self.prepare_foo_build(repo_id=123, version='4')
+        build2 = self.prepare_build('foo', True, repo_id=123, resolved=None,
+                                    version='5')
+        with self.mocks():
+            with patch.object(self.build_resolver, 'get_prev_builds_for_comparison',
+                              wraps=self.build_resolver.get_prev_builds_for_comparison) \
+                    as get_prev_builds:
+                self.build_resolver.process_builds(self.collection)
+        get_prev_builds.assert_called_once()
+        self.db.expire_all()
+        self.assertIs(True, build1.deps_resolved)
+        self.assertIs(True, build2.deps_resolved)
+        self.assertEqual(2, len(build1.dependency_changes))
+        self.assertEqual([], build2.dependency_changes)
+        self.assertIsNone(old_build.dependency_keys)
+        self.assertIsNone(build1.dependency_keys)
+        self.assertIsNotNone(build2.dependency_keys)
+
+    @with_config('dependency.build_resolver_batch_size', 1)
+    def test_process_builds_prefetched_not_expired(self):
+        self.prepare_old_build()
+        self.prepare_foo_build(repo_id=123, version='4')
+        self.prepare_build('bar', True, repo_id=122)
+        self.prepare_build('bar', True, repo_id=123, resolved=None, version='2')
+        orig_process_build = self.build_resolver.process_build
+        expired = []
+
+        def process_build(sack, build_group, build, brs, prev_builds):
+            expired.extend(
+                inspect(prev_build).expired_attributes
+                for prev_build in prev_builds.prefetched.values()
+            )
+            orig_process_build(sack, build_group, build, brs, prev_builds)
+
+        with self.mocks():
+            with patch.object(self.build_resolver, 'process_build',
+                              side_effect=process_build):
+                self.build_resolver.process_builds(self.collection)
+        # both builds have a prefetched previous build, in separate batches
+        self.assertEqual(4, len(expired))
+        self.assertEqual([set()] * 4, expired)
+
+    def test_process_builds_deleted_concurrently(self):
+        foo_build = self.prepare_foo_build(repo_id=123)
+        self.prepare_packages('bar')
+        bar_build = self.prepare_build('bar', True, repo_id=123, resolved=None)
+        bar_build_id = bar_build.id
+        orig_process_build = self.build_resolver.process_build
+
+        def process_build(sack, build_group, build, brs, prev_builds):
+            if build.id == bar_build_id:
+                # simulate concurrent deletion, rolled back together with
+                # the batch
+                self.db.execute(Build.__table__.delete().where(Build.id == build.id))
+            orig_process_build(sack, build_group, build, brs, prev_builds)
+
+        with self.mocks():
+            with patch.object(self.build_resolver, 'process_build',
+                              side_effect=process_build):
+                self.build_resolver.process_builds(self.collection)
+        self.db.expire_all()
+        self.assertIs(True, foo_build.deps_resolved)
+        self.assertIsNone(self.db.query(Build).get(bar_build_id).deps_resolved)
+
+    @with_config('dependency.build_resolver_workers', 2)
+    def test_process_builds_parallel(self):
+        foo_build = self.prepare_foo_build(repo_id=123)
+        self.prepare_packages('bar')
+        bar_build = self.prepare_build('bar', True, repo_id=124, resolved=None)
+        self.db.commit()
+        with self.mocks():
+            self.build_resolver.process_builds(self.collection)
+        self.db.expire_all()
+        self.assertIs(True, foo_build.deps_resolved)
+        self.assertIs(True, bar_build.deps_resolved)
+
+    @with_config('dependency.build_resolver_memory_limit', 3000)
+    @with_config('dependency.build_resolver_sack_memory', 1000)
+    def test_build_resolver_max_sacks(self):
+        self.assertEqual(2, self.build_resolver.get_max_sacks(2))
+        self.assertEqual(3, self.build_resolver.get_max_sacks(4))
+
     def test_dont_resolve_against_old_build_when_new_is_running(self):
         foo = self.prepare_packages('foo')[0]
         build = self.prepare_build('foo', False, repo_id=2)
@@ -268,6 +355,301 @@ class ResolverTest(DBTest):
         self.assertTrue(self.collection.latest_repo_resolved)
         self.assertEqual(123, self.collection.latest_repo_id)
 
+    @with_config('dependency.resolver_workers', 2)
+    def test_repo_generation_workers(self):
+        self.prepare_old_build()
+        self.collection.latest_repo_resolved = None
+        self.collection.latest_repo_id = None
+        self.db.commit()
+        with self.mocks(requires=['F', 'A']):
+            self.repo_resolver.main()
+        self.db.expire_all()
+        foo = self.db.query(Package).filter_by(name='foo').one()
+        self.assertTrue(foo.resolved)
+        self.assertEqual(20, foo.dependency_priority)
+        self.assertCountEqual(
+            ['C', 'E'],
+            [c.dep_name for c in foo.unapplied_changes],
+        )
+
+    def test_incremental_resolution(self):
+        self.prepare_old_build()
+        self.collection.latest_repo_resolved = None
+        self.collection.latest_repo_id = None
+        self.db.commit()
+        foo = self.db.query(Package).filter_by(name='foo').one()
+        with self.mocks(repo_id=123):
+            self.repo_resolver.main()
+        self.assertEqual(20, foo.dependency_priority)
+        foo.dependency_priority = 1
+        self.db.commit()
+        # same repo contents and buildrequires - foo is not resolved again
+        with self.mocks(repo_id=124):
+            self.repo_resolver.main()
+        self.assertEqual(124, self.collection.latest_repo_id)
+        self.assertEqual(1, foo.dependency_priority)
+        # changed buildrequires
+        with self.mocks(repo_id=125, requires=['A', 'F', 'E']):
+            self.repo_resolver.main()
+        self.assertEqual(125, self.collection.latest_repo_id)
+        self.assertNotEqual(1, foo.dependency_priority)
+        foo.dependency_priority = 1
+        self.db.commit()
+        with patch_config('dependency.incremental_resolution', False):
+            with self.mocks(repo_id=126, requires=['A', 'F', 'E']):
+                self.repo_resolver.main()
+        self.assertNotEqual(1, foo.dependency_priority)
+
+    def test_incremental_resolution_keeps_resolution_results(self):
+        self.prepare_old_build()
+        self.collection.latest_repo_resolved = None
+        self.collection.latest_repo_id = None
+        self.db.commit()
+        with self.mocks(repo_id=123):
+            self.repo_resolver.main()
+        with self.mocks(repo_id=124):
+            with patch.object(self.repo_resolver, 'resolve_dependencies') as resolve:
+                self.repo_resolver.main()
+        resolve.assert_not_called()
+        results = {
+            r.repo_id: (r.requires_hash, r.dependency_keys)
+            for r in self.db.query(ResolutionResult)
+        }
+        # copied for the skipped package
+        self.assertCountEqual([123, 124], results)
+        self.assertEqual(results[123], results[124])
+
+    def test_incremental_state_new_provider(self):
+        sack = get_sack()
+        sack_nevras = IncrementalState.get_sack_nevras(sack)
+        # B and R are new in the sack
+        state = IncrementalState(122, ['R'], frozenset(
+            nevra for nevra in sack_nevras if nevra[0] not in ('B', 'R')
+        ))
+        packages = [Mock(id=i, last_build_id=1, resolved=True) for i in range(3)]
+        # BuildRequires provided by R
+        state.record(packages[0], ['virtual >= 1'], [])
+        # installs A, which requires B
+        state.record(packages[1], ['A'], ['A'])
+        # unrelated
+        state.record(packages[2], ['C'], ['C'])
+        changed_name_ids = state.get_changed_name_ids(sack, sack_nevras)
+        self.assertTrue(state.is_affected(packages[0], ['virtual >= 1'],
+                                          changed_name_ids))
+        self.assertTrue(state.is_affected(packages[1], ['A'], changed_name_ids))
+        self.assertFalse(state.is_affected(packages[2], ['C'], changed_name_ids))
+
+    def test_dep_names(self):
+        self.assertEqual({'foo'}, depsolve.dep_names('foo >= 1.0-1'))
+        self.assertEqual(
+            {'a', 'b(x86-64)', 'c'},
+            depsolve.dep_names('(a >= 2 with b(x86-64) or (c if a))'),
+        )
+        self.assertEqual({'libc.so.6()(64bit)'}, depsolve.dep_names('libc.so.6()(64bit)'))
+        self.assertEqual(
+            {'pkgconfig(glib-2.0)', 'perl(strict)'},
+            depsolve.dep_names('(pkgconfig(glib-2.0) >= 2.0 and perl(strict))'),
+        )
+
+    @with_config('dependency.incremental_resolution', False)
+    def test_unapplied_changes_diff(self):
+        self.prepare_old_build()
+        self.collection.latest_repo_resolved = None
+        self.collection.latest_repo_id = None
+        self.db.commit()
+        foo = self.db.query(Package).filter_by(name='foo').one()
+        with self.mocks(repo_id=123):
+            self.repo_resolver.main()
+        self.db.expire_all()
+        ids = {c.dep_name: c.id for c in foo.unapplied_changes}
+        self.assertCountEqual(['C', 'E'], ids)
+        self.db.query(UnappliedChange).filter_by(id=ids['E']).update({'distance': 5})
+        self.db.commit()
+        with self.mocks(repo_id=124):
+            self.repo_resolver.main()
+        self.db.expire_all()
+        self.assertCountEqual(
+            [('C', ids['C'], 2), ('E', ids['E'], 2)],
+            [(c.dep_name, c.id, c.distance) for c in foo.unapplied_changes],
+        )
+        self.assertEqual(20, foo.dependency_priority)
+        # changes of unresolved package are deleted
+        with self.mocks(repo_id=125, requires=['nonexistent']):
+            self.repo_resolver.main()
+        self.db.expire_all()
+        self.assertFalse(foo.resolved)
+        self.assertEqual([], foo.unapplied_changes)
+
+    @with_config('dependency.package_chunk_size', 1)
+    def test_repo_generation_chunked(self):
+        self.prepare_old_build()
+        self.prepare_packages('bar')
+        self.prepare_build('bar', True, repo_id=122)
+        self.collection.latest_repo_resolved = None
+        self.collection.latest_repo_id = None
+        self.db.commit()
+        with self.mocks(requires=['F', 'A']):
+            with patch.object(self.repo_resolver, 'get_packages',
+                              wraps=self.repo_resolver.get_packages) as get_packages:
+                self.repo_resolver.main()
+        self.assertEqual(2, get_packages.call_count)
+        self.db.expire_all()
+        foo = self.db.query(Package).filter_by(name='foo').one()
+        self.assertTrue(foo.resolved)
+        self.assertEqual(20, foo.dependency_priority)
+
+    @with_config('dependency.package_chunk_size', 1)
+    @with_config('dependency.br_prefetch_depth', 0)
+    def test_repo_generation_no_prefetch(self):
+        self.prepare_old_build()
+        self.prepare_packages('bar')
+        self.prepare_build('bar', True, repo_id=122)
+        self.collection.latest_repo_resolved = None
+        self.collection.latest_repo_id = None
+        self.db.commit()
+        with self.mocks(requires=['F', 'A']):
+            with patch.object(self.repo_resolver, 'get_srpm_nvras',
+                              wraps=self.repo_resolver.get_srpm_nvras) as get_nvras:
+                self.repo_resolver.main()
+        self.assertEqual(2, get_nvras.call_count)
+        self.db.expire_all()
+        foo = self.db.query(Package).filter_by(name='foo').one()
+        self.assertTrue(foo.resolved)
+        self.assertEqual(20, foo.dependency_priority)
+
+    @with_config('dependency.package_chunk_size', 1)
+    @with_config('dependency.resolver_workers', 2)
+    def test_repo_generation_workers_wait_for_prefetch(self):
+        self.prepare_old_build()
+        self.prepare_packages('bar')
+        self.prepare_build('bar', True, repo_id=122)
+        self.collection.latest_repo_resolved = None
+        self.collection.latest_repo_id = None
+        self.db.commit()
+        parallel_process_generator = util.parallel_process_generator
+        prefetch_idle = []
+
+        def fork(*args, **kwargs):
+            pending = self.repo_resolver.br_prefetch or []
+            prefetch_idle.append(all(future.done() for _, _, future in pending))
+            return parallel_process_generator(*args, **kwargs)
+
+        with self.mocks(requires=['F', 'A']):
+            with patch('koschei.util.parallel_process_generator', side_effect=fork):
+                self.repo_resolver.main()
+        self.assertTrue(prefetch_idle)
+        self.assertTrue(all(prefetch_idle))
+        self.db.expire_all()
+        foo = self.db.query(Package).filter_by(name='foo').one()
+        self.assertTrue(foo.resolved)
+
+    def test_repo_generation_inserts_only_changed_deps(self):
+        self.prepare_foo_build()
+        self.collection.latest_repo_resolved = None
+        self.collection.latest_repo_id = None
+        self.db.commit()
+        with self.mocks(requires=['F', 'A']):
+            self.repo_resolver.main()
+        self.db.expire_all()
+        foo = self.db.query(Package).filter_by(name='foo').first()
+        self.assertTrue(foo.resolved)
+        # no previous dependencies to compare to, so there are no changes
+        self.assertEqual(0, self.db.query(Dependency).count())
+        self.assertEqual(0, self.db.query(ResolutionResult).count())
+
+    def test_build_resolver_reuses_repo_resolution(self):
+        self.prepare_old_build()
+        self.collection.latest_repo_resolved = None
+        self.collection.latest_repo_id = None
+        self.db.commit()
+        with self.mocks(requires=['F', 'A']):
+            self.repo_resolver.main()
+        self.assertEqual(1, self.db.query(ResolutionResult).count())
+        build = self.prepare_foo_build(repo_id=123, version='4')
+        with self.mocks(requires=['A', 'F']):
+            with patch.object(self.build_resolver, 'resolve_dependencies') as resolve:
+                self.build_resolver.process_builds(self.collection)
+        resolve.assert_not_called()
+        self.db.expire_all()
+        self.assertIs(True, build.deps_resolved)
+        self.assertEqual(2, len(build.dependency_changes))
+        actual_deps = (
+            self.db.query(
+                Dependency.name, Dependency.epoch, Dependency.version,
+                Dependency.release, Dependency.arch,
+            )
+            .filter(Dependency.id.in_(build.dependency_keys))
+            .all()
+        )
+        self.assertCountEqual(FOO_DEPS, actual_deps)
+
+    def test_resolution_results_cleanup(self):
+        for repo_id in (120, 121, 122):
+            self.db.add(ResolutionResult(
+                collection_id=self.collection.id, repo_id=repo_id,
+                requires_hash='r', build_group_hash='g',
+                dependency_keys=[1], distances=[1],
+            ))
+        self.collection.latest_repo_id = 122
+        self.db.commit()
+        with self.mocks(repo_id=124):
+            self.repo_resolver.resolve_repo(self.collection, 124, get_sack())
+        self.assertCountEqual(
+            [122],
+            [r.repo_id for r in self.db.query(ResolutionResult)],
+        )
+
+    def test_identical_buildrequires_resolved_once(self):
+        self.prepare_old_build()
+        self.prepare_packages('bar')
+        self.prepare_build('bar', True, repo_id=122)
+        self.collection.latest_repo_resolved = None
+        self.collection.latest_repo_id = None
+        self.db.commit()
+        with self.mocks(requires=[['F', 'A'], ['A', 'F', 'A']]):
+            with patch.object(self.repo_resolver, 'resolve_dependencies',
+                              wraps=self.repo_resolver.resolve_dependencies) as resolve:
+                self.repo_resolver.main()
+        resolve.assert_called_once()
+        self.db.expire_all()
+        for package in self.db.query(Package).filter(Package.name.in_(['foo', 'bar'])):
+            self.assertTrue(package.resolved)
+
+    @with_config('dependency.package_chunk_size', 1)
+    def test_identical_buildrequires_resolved_once_per_pass(self):
+        self.prepare_old_build()
+        self.prepare_packages('bar')
+        self.prepare_build('bar', True, repo_id=122)
+        self.collection.latest_repo_resolved = None
+        self.collection.latest_repo_id = None
+        self.db.commit()
+        with self.mocks(requires=[['F', 'A'], ['A', 'F', 'A']]):
+            with patch.object(self.repo_resolver, 'resolve_dependencies',
+                              wraps=self.repo_resolver.resolve_dependencies) as resolve:
+                self.repo_resolver.main()
+        resolve.assert_called_once()
+        self.db.expire_all()
+        for package in self.db.query(Package).filter(Package.name.in_(['foo', 'bar'])):
+            self.assertTrue(package.resolved)
+
+    @with_config('dependency.package_chunk_size', 1)
+    @with_config('dependency.resolver_workers', 2)
+    def test_repo_generation_workers_forked_once(self):
+        self.prepare_old_build()
+        self.prepare_packages('bar')
+        self.prepare_build('bar', True, repo_id=122)
+        self.collection.latest_repo_resolved = None
+        self.collection.latest_repo_id = None
+        self.db.commit()
+        with self.mocks(requires=[['F', 'A'], ['A']]):
+            with patch('koschei.util.parallel_process_generator',
+                       wraps=util.parallel_process_generator) as fork:
+                self.repo_resolver.main()
+        fork.assert_called_once()
+        self.db.expire_all()
+        for package in self.db.query(Package).filter(Package.name.in_(['foo', 'bar'])):
+            self.assertTrue(package.resolved)
+
     # pylint: disable=too-many-statements
     def test_resolve_newly_added_package(self):
         self.prepare_old_build()
@@ -431,6 +813,89 @@ class ResolverTest(DBTest):
             self.assertIsNotNone(deps)
             self.assertCountEqual(['B', 'C', 'R'], [dep.name for dep in deps])
 
+    @with_config('dependency.lazy_filelists', True)
+    def test_lazy_filelists(self):
+        with self.mocks():
+            sack = get_sack()
+            self.assertIsNotNone(sack.file_provides)
+            depsolve.prefetch_file_provides(sack, ['/usr/share/doc/A/bla', 'A'])
+            self.assertEqual(1, sack.file_provides.loads)
+            (resolved, problems, deps) = self.repo_resolver.resolve_dependencies(
+                sack, ['/usr/share/doc/A/bla', '/bin/csh'], ['R'],
+            )
+            (_, missing_problems, _) = self.repo_resolver.resolve_dependencies(
+                sack, ['/usr/share/doc/nothing'], ['R'],
+            )
+        self.assertCountEqual([], problems)
+        self.assertTrue(resolved)
+        self.assertCountEqual(['A', 'B', 'C', 'R'], [dep.name for dep in deps])
+        self.assertEqual(
+            ["No package found for: /usr/share/doc/nothing"], missing_problems,
+        )
+        self.assertEqual(['A'], sack.file_provides.names['/usr/share/doc/A/bla'])
+        self.assertEqual(2, sack.file_provides.loads)
+
+    @with_config('dependency.sack_excludes', {
+        'arches': ['src'],
+        'incompatible_arches': True,
+        'names': ['D', 'E*'],
+    })
+    def test_sack_excludes(self):
+        with self.mocks():
+            sack = get_sack()
+            self.assertEqual(0, repo_util.prune_sack(sack, 'again'))
+            (resolved, problems, _) = \
+                self.repo_resolver.resolve_dependencies(sack, ['F'], ['R'])
+        self.assertFalse(resolved)
+        self.assertEqual(1, len(problems))
+        self.assertFalse(hawkey.Query(sack).filter(name=['D', 'E']))
+        self.assertTrue(hawkey.Query(sack).filter(name='F'))
+
+    def test_selector_cache(self):
+        with self.mocks():
+            sack = get_sack()
+            first = self.repo_resolver.resolve_dependencies(sack, ['A', 'F'], ['R'])
+            second = self.repo_resolver.resolve_dependencies(sack, ['A', 'F'], ['R'])
+        self.assertEqual(
+            [(d.name, d.distance) for d in first[2]],
+            [(d.name, d.distance) for d in second[2]],
+        )
+        self.assertEqual(3, sack.selector_cache.misses)
+        self.assertEqual(7, sack.selector_cache.hits)
+        sack.clear_caches()
+        self.assertFalse(sack.selector_cache.selectors)
+
+    def test_distance_depth_limit(self):
+        with self.mocks():
+            sack = get_sack()
+            deps = self.repo_resolver.resolve_dependencies(sack, ['A', 'F'], ['R'])[2]
+            graph = sack.dependency_graph
+            self.assertIsNotNone(graph)
+            distances = {d.name: d.distance for d in deps}
+            for dep in deps:
+                dep.distance = None
+            depsolve.compute_dependency_distances(sack, ['A', 'F'], deps, depth_limit=2)
+            self.assertIs(graph, sack.dependency_graph)
+        for dep in deps:
+            if distances[dep.name] == 1:
+                self.assertEqual(1, dep.distance)
+            else:
+                self.assertIsNone(dep.distance)
+
+    def test_lazy_dependency_graph(self):
+        with self.mocks():
+            sack = get_sack()
+            deps = self.repo_resolver.resolve_dependencies(sack, ['A', 'F'], ['R'])[2]
+            distances = {d.name: d.distance for d in deps}
+            for dep in deps:
+                dep.distance = None
+            sack.dependency_graph = depsolve.LazyDependencyGraph(sack)
+            depsolve.compute_dependency_distances(sack, ['A', 'F'], deps)
+            graph = sack.dependency_graph
+            self.assertIsInstance(graph, depsolve.LazyDependencyGraph)
+            self.assertTrue(graph.edges)
+        self.assertEqual(distances, {d.name: d.distance for d in deps})
+
     # qt-x11 requires (sni-qt(x86-64) if plasma-workspace)
     # since plasma-workspace is not installed, sni-qt should not be instaled either
     @skipIf(rpmvercmp(hawkey.VERSION, MINIMAL_HAWKEY_VERSION) < 0,
@@ -65,3 +65,21 @@ class ServiceTest(AbstractTest):
     def test_find_inherited(self):
         svc = Service.find_service('inherited_service')
         self.assertIs(InheritedService, svc)
+
+    def test_memory_check(self):
+        session = Mock()
+        session.clear_resident_sacks.return_value = True
+        s = MyService(session=session)
+        s.service_config = {'memory_limit': 1}
+        with self.assertRaises(SystemExit) as ctx:
+            s.memory_check()
+        self.assertEqual(3, ctx.exception.code)
+        # loaded sacks were dropped before giving up
+        session.clear_resident_sacks.assert_called_once_with()
+
+    def test_memory_check_under_limit(self):
+        session = Mock()
+        s = MyService(session=session)
+        s.service_config = {'memory_limit': 2 ** 40}
+        s.memory_check()
+        session.clear_resident_sacks.assert_not_called()
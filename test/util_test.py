@@ -0,0 +1,61 @@
+# Copyright (C) 2014-2016  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import time
+
+from mock import patch
+
+from test.common import AbstractTest
+from koschei import util
+
+
+def slow_fn(arg):
+    time.sleep(60)
+    return arg
+
+
+def failing_fn(arg):
+    raise ValueError(arg)
+
+
+class ParallelProcessGeneratorTest(AbstractTest):
+    def test_results(self):
+        gen = util.parallel_process_generator(
+            lambda x: x * 2, ((i, i) for i in range(20)), workers=3,
+        )
+        self.assertEqual([(i, i * 2) for i in range(20)], sorted(gen))
+
+    @patch.object(util.parallel_process_generator, 'poll_interval', 0.1)
+    def test_stop_with_full_task_queue(self):
+        gen = util.parallel_process_generator(
+            slow_fn, ((i, i) for i in range(100)), workers=2, queue_size=2,
+        )
+        time.sleep(0.5)
+        gen.stop()
+        gen.feeder.join(5)
+        self.assertFalse(gen.feeder.is_alive())
+        self.assertFalse(any(p.is_alive() for p in gen.processes))
+
+    @patch.object(util.parallel_process_generator, 'poll_interval', 0.1)
+    def test_worker_failure_stops_feeder(self):
+        gen = util.parallel_process_generator(
+            failing_fn, ((i, i) for i in range(100)), workers=2, queue_size=2,
+        )
+        with self.assertRaises(RuntimeError):
+            list(gen)
+        gen.feeder.join(5)
+        self.assertFalse(gen.feeder.is_alive())